@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Compares the consensus backends of stRainy on the clusters of a finished run:
+reports the time spent by the Flye polisher and by the pileup consensus,
+and the identity of the two consensuses of every cluster.
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import edlib
+
+from strainy.params import init_global_args_storage
+from strainy.clustering.cluster_assignment import ClusterAssignment
+from strainy.flye_consensus import FlyeConsensus
+
+
+def load_clusters(strainy_dir, max_clusters, min_reads):
+    targets = []
+    csv_files = glob.glob(os.path.join(strainy_dir, "intermediate", "clusters", "clusters_*.csv"))
+    for filename in sorted(csv_files):
+        name = os.path.basename(filename)
+        if name.startswith("clusters_before_splitting"):
+            continue
+        edge = name[len("clusters_"):-len(".csv")].rsplit("_", 2)[0]
+        cl = ClusterAssignment.read_csv(filename)
+        for cluster in cl.clusters():
+            if cl.size(cluster) >= min_reads:
+                targets.append((cluster, edge, cl))
+            if len(targets) == max_clusters:
+                return targets
+    return targets
+
+
+def run_backend(backend, targets, args, manager):
+    fc = FlyeConsensus(args.bam, args.fasta, 1, {}, manager, backend=backend)
+    start = time.time()
+    consensus = [fc.flye_consensus(cluster, edge, cl)["consensus"] for cluster, edge, cl in targets]
+    return time.time() - start, consensus
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the stRainy consensus backends")
+    parser.add_argument("strainy_dir", help="output directory of a stRainy run")
+    parser.add_argument("--bam", help="alignment used by the run (default: <strainy_dir>/preprocessing_data/long_unitigs_split.bam)")
+    parser.add_argument("--fasta", help="unitig sequences (default: <strainy_dir>/preprocessing_data/gfa_converted.fasta)")
+    parser.add_argument("-m", "--mode", choices=["hifi", "nano"], default="hifi")
+    parser.add_argument("-n", "--clusters", type=int, default=100, help="number of clusters to compare")
+    parser.add_argument("--min-reads", type=int, default=3, help="minimum number of reads in a compared cluster")
+    args = parser.parse_args()
+
+    preprocessing_dir = os.path.join(args.strainy_dir, "preprocessing_data")
+    args.bam = args.bam or os.path.join(preprocessing_dir, "long_unitigs_split.bam")
+    args.fasta = args.fasta or os.path.join(preprocessing_dir, "gfa_converted.fasta")
+
+    targets = load_clusters(args.strainy_dir, args.clusters, args.min_reads)
+    if len(targets) == 0:
+        print("No clusters found", file=sys.stderr)
+        return 1
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        #the consensuses are computed in a scratch output, with an empty consensus cache
+        strainy_args = argparse.Namespace(output=work_dir, bam=args.bam, gfa=None, mode=args.mode, snp=None, threads=1,
+                                          graph_edges=[], fasta=args.fasta, fastq=None, unitig_split_length=0,
+                                          debug=False, cluster_divergence=0, allele_frequency=0,
+                                          min_unitig_length=0, min_unitig_coverage=0, max_unitig_coverage=0,
+                                          edges_to_phase=[], consensus_cache=os.path.join(work_dir, "consensus_cache"),
+                                          consensus_cache_size=1, scratch_dir=None, scratch_size=1)
+        init_global_args_storage(strainy_args)
+
+        manager = multiprocessing.Manager()
+        flye_time, flye_consensus = run_backend("flye", targets, args, manager)
+        pileup_time, pileup_consensus = run_backend("pileup", targets, args, manager)
+
+    print("Cluster\tEdge\tReads\tFlye_len\tPileup_len\tIdentity")
+    identities = []
+    for (cluster, edge, cl), first, second in zip(targets, flye_consensus, pileup_consensus):
+        first, second = str(first), str(second)
+        if max(len(first), len(second)) == 0:
+            identity = 1.0
+        else:
+            distance = edlib.align(first, second, "NW", "distance")["editDistance"]
+            identity = 1 - distance / max(len(first), len(second))
+        identities.append(identity)
+        print(f"{cluster}\t{edge}\t{cl.size(cluster)}\t{len(first)}\t{len(second)}\t{identity:.5f}")
+
+    print(f"\nClusters: {len(targets)}")
+    print(f"Flye polisher: {flye_time:.2f} s, pileup: {pileup_time:.2f} s, speedup: {flye_time / max(pileup_time, 1e-9):.1f}x")
+    print(f"Mean identity: {sum(identities) / len(identities):.5f}, min identity: {min(identities):.5f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,22 @@
+import os
 import logging
+import heapq
+import pickle
+import tempfile
 
+import numpy as np
 import pandas as pd
 from scipy.spatial.distance import cdist
 
 from strainy.params import *
+from strainy.work_queue import shared_map, idle_helpers
 
 logger = logging.getLogger()
 #pd.options.mode.chained_assignment = None
 
 class DistanceWrapper():
     # Wrapper for calling cdist with custom distance function
-    def __init__(self, cl, data, SNP_pos, R, only_with_common_snip):
-        self.cl = cl
+    def __init__(self, data, SNP_pos, R, only_with_common_snip):
         self.data = data
         self.SNP_pos = SNP_pos
         self.R = R
@@ -26,12 +31,83 @@ class DistanceWrapper():
                         self.only_with_common_snip)
 
 
-def build_adj_matrix(cl, data, SNP_pos, I, file, edge, R, only_with_common_snip=True):
-    m = pd.DataFrame(-1.0, index=cl['ReadName'], columns=cl['ReadName'])
-    logger.debug("Building adjacency matrix with " + str(m.shape[1]) + " reads")
+def distance_rows(row_names, read_names, data, SNP_pos, R, only_with_common_snip):
+    """
+    Distances from the row_names reads to all reads (a horizontal tile of the adjacency matrix)
+    """
+    dw = DistanceWrapper(data, SNP_pos, R, only_with_common_snip)
+    return cdist(row_names.to_frame(), read_names.to_frame(), dw.distance_wrapper)
+
+
+#the shared distance matrices are memory-mapped files, in memory (tmpfs) where it is available
+_shared_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+#inputs of the shared distance matrices: the ones submitted by this process (by file),
+#and the last one loaded from a file by this process as a helper
+_own_tile_inputs = {}
+_loaded_tile_inputs = {}
+
+
+def _tile_inputs(inputs_path):
+    """
+    Reads the inputs of a shared distance matrix once per process
+    """
+    if inputs_path in _own_tile_inputs:
+        return _own_tile_inputs[inputs_path]
+    if inputs_path not in _loaded_tile_inputs:
+        _loaded_tile_inputs.clear()
+        with open(inputs_path, "rb") as f:
+            _loaded_tile_inputs[inputs_path] = pickle.load(f)
+    return _loaded_tile_inputs[inputs_path]
+
+
+def _distance_tile(inputs_path, matrix_path, begin, end):
+    """
+    Computes the rows begin:end of a shared distance matrix and writes them to its mapped file
+    """
+    read_names, data, SNP_pos, R, only_with_common_snip = _tile_inputs(inputs_path)
+    tile = distance_rows(read_names[begin:end], read_names, data, SNP_pos, R, only_with_common_snip)
+    result = np.memmap(matrix_path, dtype=np.float64, mode="r+", shape=(len(read_names), len(read_names)))
+    result[begin:end] = tile
+    del result
+
+
+def distance_matrix(read_names, data, SNP_pos, R, only_with_common_snip):
+    """
+    Computes the read distance matrix, split into row tiles shared with the idle workers
+    if the unitig is large and there are any.
+    The reads are written to a file that every helper reads once, and the tiles are written
+    directly to a memory-mapped matrix file, so the jobs only carry the file names.
+    The files are removed once the tiles are done, the returned matrix stays mapped until it is freed
+    """
+    helpers = idle_helpers()
+    if len(read_names) < parallel_min_reads or helpers == 0:
+        return distance_rows(read_names, read_names, data, SNP_pos, R, only_with_common_snip)
+
+    n_tiles = 2 * (helpers + 1)
+    bounds = np.linspace(0, len(read_names), n_tiles + 1, dtype=int)
+    inputs = (read_names, {read: data[read] for read in read_names}, SNP_pos, R, only_with_common_snip)
+    inputs_fd, inputs_path = tempfile.mkstemp(prefix="strainy_tiles_", suffix=".pickle", dir=_shared_dir)
+    matrix_fd, matrix_path = tempfile.mkstemp(prefix="strainy_matrix_", dir=_shared_dir)
+    _own_tile_inputs[inputs_path] = inputs
+    try:
+        with os.fdopen(inputs_fd, "wb") as f:
+            pickle.dump(inputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.ftruncate(matrix_fd, len(read_names) ** 2 * 8)
+        shared_map(_distance_tile, [(inputs_path, matrix_path, b, e) for b, e in zip(bounds[:-1], bounds[1:])])
+        result = np.memmap(matrix_path, dtype=np.float64, mode="r+", shape=(len(read_names), len(read_names)))
+    finally:
+        del _own_tile_inputs[inputs_path]
+        os.close(matrix_fd)
+        os.remove(inputs_path)
+        os.remove(matrix_path)
+    return result.view(np.ndarray)
+
+
+def build_adj_matrix(read_names, data, SNP_pos, I, file, edge, R, only_with_common_snip=True):
+    read_names = pd.Series(read_names, name='ReadName')
+    logger.debug("Building adjacency matrix with " + str(len(read_names)) + " reads")
     if only_with_common_snip==False:
-        dw = DistanceWrapper(cl, data, SNP_pos, R, only_with_common_snip)
-        result = cdist(cl['ReadName'].to_frame(), cl['ReadName'].to_frame(), dw.distance_wrapper)
+        result = distance_matrix(read_names, data, SNP_pos, R, only_with_common_snip)
 
         # Set the first row and the column to -1
         try:
@@ -41,17 +117,15 @@ def build_adj_matrix(cl, data, SNP_pos, I, file, edge, R, only_with_common_snip=
             pass
 
         result_df = pd.DataFrame(result, 
-                         index=cl['ReadName'],
-                         columns=cl['ReadName'])
+                         index=read_names,
+                         columns=read_names)
     else:
-
-        dw = DistanceWrapper(cl, data, SNP_pos, R, only_with_common_snip)
-        result = cdist(cl['ReadName'].to_frame(), cl['ReadName'].to_frame(), dw.distance_wrapper)
+        result = distance_matrix(read_names, data, SNP_pos, R, only_with_common_snip)
 
         result[0,:] = -1
         result_df = pd.DataFrame(result, 
-                        index=cl['ReadName'],
-                        columns=cl['ReadName'])
+                        index=read_names,
+                        columns=read_names)
 
     return result_df
 
@@ -138,3 +212,111 @@ def distance_clusters(edge,first_cl,second_cl, cons,cl, flye_consensus, only_wit
     else:
         d = 1
     return float(d)
+
+
+def alignment_needed(first_cl, second_cl, cons, only_with_common_snip=True):
+    """
+    Whether distance_clusters compares the two (overlapping) clusters by the alignment of their consensuses
+    """
+    keys=('clSNP','clSNP2', 'Strange', 'Strange2','End','Start','Cov')
+    firstSNPs = set([int(key) for key in cons[first_cl].keys() if key not in keys])
+    secondSNPs = set([int(key) for key in cons[second_cl].keys() if key not in keys])
+    if only_with_common_snip == False:
+        return len(firstSNPs.intersection(secondSNPs)) != 0
+    return len(set(cons[first_cl]["clSNP2"]).intersection(set(cons[second_cl]["clSNP2"]))) != 0
+
+
+def _wilson_bounds(successes, trials, z):
+    """
+    Wilson score confidence interval of a binomial proportion (arrays of counts)
+    """
+    trials = np.maximum(trials, 1)
+    p = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (p + z ** 2 / (2 * trials)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return center - half_width, center + half_width
+
+
+def allele_profiles(clusters, cons):
+    """
+    Matrix of the consensus alleles of the clusters (rows) at the SNP positions (columns),
+    0 where a cluster has no consensus allele
+    """
+    keys=('clSNP','clSNP2', 'Strange', 'Strange2','End','Start','Cov')
+    positions = sorted({int(key) for cluster in clusters for key in cons[cluster].keys() if key not in keys})
+    column = {pos: i for i, pos in enumerate(positions)}
+    codes = {}
+    profiles = np.zeros((len(clusters), len(positions)), dtype=np.int16)
+    for row, cluster in enumerate(clusters):
+        for key, allele in cons[cluster].items():
+            if key in keys:
+                continue
+            profiles[row, column[int(key)]] = codes.setdefault(allele, len(codes) + 1)
+    return profiles
+
+
+def prescreen_pairs(pairs, cons, R, only_with_common_snip=True):
+    """
+    Decides the distance of the cluster pairs that would be compared by consensus alignment
+    from their allele profiles, when the profiles are clearly distinct:
+    the fraction of discordant alleles at the common SNP positions is compared to profile_distinct_bound
+    through the lower bound of its Wilson confidence interval (z = profile_confidence_z).
+    Distinct pairs get the fraction of the intersection that has discordant alleles if even its lower
+    confidence bound is above R. Pairs with concordant alleles are always aligned, as the alignment
+    also counts the mismatches outside of the SNPs and the indel blocks.
+    Returns the distances of the decided pairs (by pair)
+    """
+    candidates = []
+    for first_cl, second_cl in pairs:
+        intersect = max(min(cons[first_cl]["End"], cons[second_cl]["End"]) - max(cons[first_cl]["Start"], cons[second_cl]["Start"]), 0)
+        if intersect > I and alignment_needed(first_cl, second_cl, cons, only_with_common_snip):
+            candidates.append((first_cl, second_cl, intersect))
+    if len(candidates) == 0:
+        return {}
+
+    clusters = sorted({cluster for first_cl, second_cl, _ in candidates for cluster in (first_cl, second_cl)})
+    row = {cluster: i for i, cluster in enumerate(clusters)}
+    profiles = allele_profiles(clusters, cons)
+    first = np.array([row[first_cl] for first_cl, _, _ in candidates])
+    second = np.array([row[second_cl] for _, second_cl, _ in candidates])
+    intersect = np.array([intersect for _, _, intersect in candidates], dtype=float)
+
+    #pairs are compared in chunks, so that the pair x position matrices stay small
+    common = np.zeros(len(candidates), dtype=np.int64)
+    discordant = np.zeros(len(candidates), dtype=np.int64)
+    chunk = max(1, 2 ** 22 // max(profiles.shape[1], 1))
+    for i in range(0, len(candidates), chunk):
+        first_alleles = profiles[first[i:i + chunk]]
+        second_alleles = profiles[second[i:i + chunk]]
+        both = (first_alleles != 0) & (second_alleles != 0)
+        common[i:i + chunk] = both.sum(axis=1)
+        discordant[i:i + chunk] = (both & (first_alleles != second_alleles)).sum(axis=1)
+
+    lower, _ = _wilson_bounds(discordant, common, profile_confidence_z)
+    distinct = (common > 0) & (lower >= profile_distinct_bound) & (lower * common / intersect > R)
+
+    decided = {}
+    for i, (first_cl, second_cl, _) in enumerate(candidates):
+        if distinct[i]:
+            decided[(first_cl, second_cl)] = float(discordant[i] / intersect[i])
+    return decided
+
+
+def overlapping_cluster_pairs(clusters, cons, min_overlap):
+    """
+    Yields the pairs of clusters which intervals intersect by more than min_overlap.
+    Sweeps over the clusters sorted by start, keeping the clusters that are still open
+    in a heap by end, so the cost is O(k log k) plus the number of reported pairs.
+    """
+    active = []
+    for i, cluster in enumerate(sorted(clusters, key=lambda c: cons[c]["Start"])):
+        start = int(cons[cluster]["Start"])
+        end = int(cons[cluster]["End"])
+        while active and active[0][0] - start <= min_overlap:
+            heapq.heappop(active)
+        if end - start <= min_overlap:
+            continue
+        for _, _, other in active:
+            yield other, cluster
+        heapq.heappush(active, (end, i, cluster))
@@ -4,9 +4,8 @@ import os
 import io
 import re
 from collections import Counter, namedtuple
-from Bio import SeqIO
-
 from strainy.params import *
+from strainy.reference_store import get_reference_store
 
 import logging
 logger = logging.getLogger()
@@ -229,19 +228,11 @@ def read_bam(bam, edge, SNP_pos, min_mapping_quality,min_base_quality, min_al_le
 
 
 def read_fasta_seq(filename, seq_name):
-    reference_seq = None
-    for seq in SeqIO.parse(filename, "fasta"):
-        if seq.id == seq_name:
-            reference_seq = str(seq.seq)
-            break
-    if reference_seq is None:
-        raise Exception("Reference sequence not found")
-
-    return reference_seq
+    return get_reference_store(filename).fetch(seq_name)
 
 
 def build_data_cons(cl, SNP_pos, data, edge, reference_seq):
-    clusters = sorted(set(cl.loc[cl['Cluster'] != 'NA']['Cluster'].values))
+    clusters = cl.clusters()
     cons = {}
     for cluster in clusters:
         cons = cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq)
@@ -257,9 +248,10 @@ def cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq):
     mis_count=0
     Rcl=StRainyArgs().Rcl
     AF=StRainyArgs().AF
+    cluster_reads = cl.reads(cluster)
     for pos in SNP_pos:
         npos = []
-        for read in cl.loc[cl['Cluster'] == cluster]['ReadName'].values:
+        for read in cluster_reads:
             try:
                 npos.append(data[read][pos])
             except(KeyError):
@@ -301,7 +293,7 @@ def cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq):
     starts=[]
     ends=[]
 
-    for read in cl.loc[cl['Cluster'] == cluster]['ReadName'].values:
+    for read in cluster_reads:
         try:
             start=int(data[read]["Start"])
             stop=data[read]["End"]
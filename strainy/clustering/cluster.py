@@ -5,14 +5,15 @@ import matplotlib.pyplot as plt
 import matplotlib as mt
 logging.getLogger('matplotlib.font_manager').disabled = True
 import multiprocessing
-import pandas as pd
 import pysam
 
 from strainy.clustering.community_detection import find_communities
+from strainy.clustering.cluster_assignment import ClusterAssignment, REMOVED_READ
 from strainy.clustering.cluster_postprocess import postprocess
 import strainy.clustering.build_adj_matrix as matrix
 import strainy.clustering.build_data as build_data
 from strainy.params import *
+from strainy.reference_store import get_reference_store
 import strainy.gfa_operations.gfa_ops as gfa_ops
 
 
@@ -20,27 +21,21 @@ logger = logging.getLogger()
 
 
 def clusters_vis_stats(G, cl, clN, uncl, bam, edge, I, AF):
-    cl.loc[cl['Cluster'] == 'NA', 'Cluster'] = 0
     cmap = plt.get_cmap('viridis')
-    clusters=sorted(set(cl['Cluster'].astype(int)))
+    clusters = cl.clusters()
     cmap = cmap(np.linspace(0, 1, len(clusters)))
     colors = {}
-    try:
-        clusters.remove('0')
-    except:
-        KeyError
-    colors[0] = "#505050"
+    colors[REMOVED_READ] = "#505050"
     i = 0
 
     for cluster in clusters:
         colors[cluster] = mt.colors.to_hex(cmap[i])
         i = i + 1
 
-    for index in cl.index:
-        cl.loc[index, 'Color'] = colors[int(cl.loc[index, 'Cluster'])]
-        G.remove_edges_from(list(nx.selfloop_edges(G)))
+    G.remove_edges_from(list(nx.selfloop_edges(G)))
+    node_colors = [colors[cl.cluster_of(read_idx)] for read_idx in G.nodes()]
     try:
-        nx.draw(G, nodelist=G.nodes(), with_labels=True, width=0.03, node_size=10, font_size=10,node_color=cl['Color'])
+        nx.draw(G, nodelist=G.nodes(), with_labels=True, width=0.03, node_size=10, font_size=10,node_color=node_colors)
     except AttributeError:  #incompatability with scipy < 1.8
         pass
 
@@ -55,7 +50,7 @@ def clusters_vis_stats(G, cl, clN, uncl, bam, edge, I, AF):
     logger.debug("Clusters found: " + str(clN))
     logger.debug("Reads unclassified: " + str(uncl))
     logger.debug("Number of reads in each cluster: ")
-    logger.debug(cl['Cluster'].value_counts(dropna=False))
+    logger.debug(cl.counts())
 
 
 def cluster(i, flye_consensus):
@@ -70,15 +65,11 @@ def cluster(i, flye_consensus):
     logger.info("### Reading Reads...")
 
     data = build_data.read_bam(StRainyArgs().bam, edge, SNP_pos, min_mapping_quality,min_base_quality, min_al_len, de_max[StRainyArgs().mode])
-    cl = pd.DataFrame(columns=['ReadName', 'Cluster', 'Start'])
-    for key, value in data.items():
-        row = pd.DataFrame({'ReadName':[key], 'Cluster':['NA'], 'Start':[value['Start']]})
-        cl = pd.concat([cl, row])
-    cl = cl.reset_index(drop=True)
+    cl = ClusterAssignment.from_read_data(data)
 
 
     total_coverage = 0
-    edge_length = len(build_data.read_fasta_seq(StRainyArgs().fa, edge))
+    edge_length = get_reference_store(StRainyArgs().fa).length(edge)
     num_reads = len(data)
     for read in data:
         total_coverage += data[read]["End"] - data[read]["Start"]
@@ -89,13 +80,7 @@ def cluster(i, flye_consensus):
         return
     if len(SNP_pos) == 0:
         #data = read_bam(StRainyArgs().bam, edge, SNP_pos, min_mapping_quality, min_al_len, de_max[StRainyArgs().mode])
-        cl = pd.DataFrame(columns=['ReadName', 'Cluster', 'Start'])
-        for key, value in data.items():
-            row = pd.DataFrame({'ReadName':[key], 'Cluster':['NA'], 'Start':[value['Start']]})
-            cl = pd.concat([cl, row])
-        cl = cl.reset_index(drop=True)
-
-        cl['Cluster'] = 1
+        cl.relabel(UNCLUSTERED_GROUP_N, 1)
         cl.to_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, AF))
         return
 
@@ -104,7 +89,7 @@ def cluster(i, flye_consensus):
     #try:
     #    m = pd.read_csv("%s/adj_M/adj_M_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, AF), index_col='ReadName')
     #except FileNotFoundError:
-    m = matrix.build_adj_matrix(cl, data, SNP_pos, I, StRainyArgs().bam, edge, R)
+    m = matrix.build_adj_matrix(cl.read_names, data, SNP_pos, I, StRainyArgs().bam, edge, R)
     if StRainyArgs().debug:
         m.to_csv("%s/adj_M/adj_M_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, AF))
     logger.info("### Removing overweighed egdes...")
@@ -112,8 +97,8 @@ def cluster(i, flye_consensus):
     # BUILD graph and find clusters
     logger.info("### Creating graph...")
     m1 = m
-    m1.columns = range(0,len(cl['ReadName']))
-    m1.index=range(0,len(cl['ReadName']))
+    m1.columns = range(0,len(cl))
+    m1.index=range(0,len(cl))
     G = gfa_ops.from_pandas_adjacency_notinplace(matrix.change_w(m.transpose(), R))
     logger.info("### Searching clusters...")
     cluster_membership = find_communities(G)
@@ -124,8 +109,8 @@ def cluster(i, flye_consensus):
         group = [k for k, v in cluster_membership.items() if v == value]
         if len(group) > 3:
             clN = clN + 1
-            cl.loc[group, 'Cluster'] = value
-            #cl['Cluster'][group] = value
+            for read_idx in group:
+                cl.assign(read_idx, value)
         else:
             uncl = uncl + 1
 
@@ -133,13 +118,11 @@ def cluster(i, flye_consensus):
     if StRainyArgs().debug:
         cl.to_csv("%s/clusters/clusters_before_splitting_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, AF))
 
-    cl.loc[cl['Cluster'] == 'NA', 'Cluster'] = UNCLUSTERED_GROUP_N
     if clN != 0:
         logger.info("### Cluster post-processing...")
         cl = postprocess(StRainyArgs().bam, cl, SNP_pos, data, edge, R,Rcl, I, flye_consensus,mean_edge_cov)
     else:
-        counts = cl['Cluster'].value_counts(dropna=False)
-        cl = cl[~cl['Cluster'].isin(counts[counts < 6].index)]
+        cl.remove_small(6)
     #clN = len(set(cl.loc[cl['Cluster']!='NA']['Cluster'].values))
     logger.info(str(clN) + " clusters after post-processing")
     cl.to_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, AF))
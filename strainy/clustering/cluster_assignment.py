@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+from strainy.params import *
+
+
+REMOVED_READ = -1
+
+
+class ClusterAssignment:
+    """
+    Read-to-cluster assignment for a single unitig.
+    Cluster ids are stored as an int32 array indexed by read, together
+    with a cluster -> read indices map, so that reassigning a read is O(1)
+    and fetching the members of a cluster is O(k).
+    Reads removed from the clustering are kept in the arrays,
+    but are no longer members of any cluster.
+    """
+    def __init__(self, read_names, starts, clusters=None):
+        self._read_names = list(read_names)
+        self._starts = np.asarray(starts, dtype=np.int64)
+        if clusters is None:
+            self._clusters = np.full(len(self._read_names), UNCLUSTERED_GROUP_N, dtype=np.int32)
+        else:
+            self._clusters = np.asarray(clusters, dtype=np.int32)
+        self._members = defaultdict(set)
+        for i, cluster in enumerate(self._clusters.tolist()):
+            if cluster != REMOVED_READ:
+                self._members[cluster].add(i)
+
+    @classmethod
+    def from_read_data(cls, data):
+        """
+        Creates an assignment with all reads from read_bam() output unclustered
+        """
+        return cls(list(data.keys()), [value["Start"] for value in data.values()])
+
+    @classmethod
+    def read_csv(cls, filename):
+        df = pd.read_csv(filename, keep_default_na=False)
+        return cls(df["ReadName"].astype(str), df["Start"].values, df["Cluster"].values)
+
+    def to_csv(self, filename):
+        idx = np.flatnonzero(self._clusters != REMOVED_READ)
+        df = pd.DataFrame({"ReadName": [self._read_names[i] for i in idx],
+                           "Cluster": self._clusters[idx],
+                           "Start": self._starts[idx]},
+                          index=idx)
+        df.to_csv(filename)
+
+    def __len__(self):
+        return len(self._read_names)
+
+    def __contains__(self, cluster):
+        return cluster in self._members
+
+    @property
+    def read_names(self):
+        return self._read_names
+
+    def clusters(self):
+        """
+        Sorted list of the non-empty cluster ids
+        """
+        return sorted(self._members)
+
+    def cluster_of(self, read_idx):
+        return int(self._clusters[read_idx])
+
+    def size(self, cluster):
+        return len(self._members.get(cluster, ()))
+
+    def counts(self):
+        return {cluster: len(members) for cluster, members in self._members.items()}
+
+    def members(self, cluster):
+        """
+        Read indices of the cluster, in the order of the initial read list
+        """
+        return sorted(self._members.get(cluster, ()))
+
+    def reads(self, cluster):
+        return [self._read_names[i] for i in self.members(cluster)]
+
+    def starts(self, cluster):
+        return [int(self._starts[i]) for i in self.members(cluster)]
+
+    def subset(self, clusters):
+        """
+        Assignment of the reads of the given clusters only
+        """
+        idx = sorted(i for cluster in clusters for i in self._members.get(cluster, ()))
+        return ClusterAssignment([self._read_names[i] for i in idx], self._starts[idx], self._clusters[idx])
+
+    def clusters_of(self, read_names):
+        """
+        Cluster ids of the given reads (reads that are not clustered are skipped)
+        """
+        read_names = set(read_names)
+        return [int(cluster) for name, cluster in zip(self._read_names, self._clusters.tolist())
+                if name in read_names and cluster != REMOVED_READ]
+
+    def assign(self, read_idx, cluster):
+        old_cluster = int(self._clusters[read_idx])
+        if old_cluster == cluster:
+            return
+        if old_cluster != REMOVED_READ:
+            old_members = self._members[old_cluster]
+            old_members.discard(read_idx)
+            if not old_members:
+                del self._members[old_cluster]
+        self._clusters[read_idx] = cluster
+        if cluster != REMOVED_READ:
+            self._members[cluster].add(read_idx)
+
+    def relabel(self, old_cluster, new_cluster):
+        """
+        Moves all reads of old_cluster to new_cluster (merging, if the latter exists)
+        """
+        if old_cluster == new_cluster or old_cluster not in self._members:
+            return
+        old_members = self._members.pop(old_cluster)
+        self._clusters[list(old_members)] = new_cluster
+        if new_cluster != REMOVED_READ:
+            self._members[new_cluster].update(old_members)
+
+    def remove(self, cluster):
+        self.relabel(cluster, REMOVED_READ)
+
+    def remove_small(self, min_size):
+        for cluster, size in self.counts().items():
+            if size < min_size:
+                self.remove(cluster)
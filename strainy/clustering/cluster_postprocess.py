@@ -1,5 +1,6 @@
 import networkx as nx
 import logging
+import numpy as np
 import pandas as pd
 
 from strainy.clustering.community_detection import find_communities
@@ -7,6 +8,7 @@ import strainy.clustering.build_adj_matrix as matrix
 import strainy.clustering.build_data as build_data
 import strainy.gfa_operations.gfa_ops as gfa_ops
 from strainy.params import *
+from strainy.work_queue import shared_map, idle_helpers, shared_object
 
 logger = logging.getLogger()
 
@@ -14,21 +16,21 @@ logger = logging.getLogger()
 def split_cluster(cl,cluster, data,cons,clSNP, bam, edge, R, I,only_with_common_snip=True):
     #logging.debug("Split cluster: " + str(cluster)+ " "+ str(only_with_common_snip))
     child_clusters = []
-    reads = sorted(set(cl.loc[cl["Cluster"] == cluster,"ReadName"].values))
+    members = cl.members(cluster)
+    reads = [cl.read_names[i] for i in members]
     if cluster == UNCLUSTERED_GROUP_N or cluster==UNCLUSTERED_GROUP_N2  or only_with_common_snip==False: #NA cluster
-        m = matrix.build_adj_matrix(cl[cl["Cluster"] == cluster], data, clSNP, I, bam, edge, R, only_with_common_snip=False)
+        m = matrix.build_adj_matrix(reads, data, clSNP, I, bam, edge, R, only_with_common_snip=False)
     else:
-        m = matrix.build_adj_matrix(cl[cl["Cluster"] == cluster], data, clSNP, I, bam,edge,R)
+        m = matrix.build_adj_matrix(reads, data, clSNP, I, bam,edge,R)
     m = matrix.remove_edges(m, 1)
-    m.columns = range(0,len(cl[cl["Cluster"] == cluster]["ReadName"]))
-    m.index = range(0,len(cl[cl["Cluster"] == cluster]["ReadName"]))
+    m.columns = range(0,len(reads))
+    m.index = range(0,len(reads))
     m = matrix.change_w(m, R)
     G_sub = gfa_ops.from_pandas_adjacency_notinplace(m)
-    cl_exist = sorted(set(cl.loc[cl["Cluster"] != "NA","Cluster"].values))+list(cons.keys())
+    cl_exist = set(cl.clusters()) | set(cons.keys())
     cluster_membership = find_communities(G_sub)
     clN = 0
     uncl = 0
-    reads = cl[cl["Cluster"] == cluster]["ReadName"].values
     new_cl_id_na = cluster + SPLIT_ID
     while new_cl_id_na in cl_exist:
         new_cl_id_na = new_cl_id_na + 1
@@ -41,25 +43,25 @@ def split_cluster(cl,cluster, data,cons,clSNP, bam, edge, R, I,only_with_common_
                 while new_cl_id in cl_exist:
                     new_cl_id = new_cl_id+1
                     child_clusters.append(new_cl_id)
-                cl_exist.append(new_cl_id)
+                cl_exist.add(new_cl_id)
                 for i in group:
-                     mask = cl["ReadName"] == str(reads[i])
-                     cl.loc[mask, "Cluster"] = new_cl_id
+                    cl.assign(members[i], new_cl_id)
             else:
                 uncl = uncl + 1
-                for i in group:
-                    mask = cl["ReadName"] == str(reads[i])
+                read_idx = members[group[-1]]
                 if only_with_common_snip == True and cluster!=UNCLUSTERED_GROUP_N: #change it for parameter process NA or not
-                    cl.loc[mask, "Cluster"] = new_cl_id_na
+                    cl.assign(read_idx, new_cl_id_na)
                     child_clusters.append(new_cl_id_na)
                 else:
-                    cl.loc[mask, "Cluster"] = UNCLUSTERED_GROUP_N
+                    cl.assign(read_idx, UNCLUSTERED_GROUP_N)
     return [new_cl_id_na, clN]
 
 
-def build_adj_matrix_clusters(edge,cons,cl,flye_consensus, only_with_common_snip=True, set_slusters=None):
+def build_adj_matrix_clusters(edge,cons,cl,flye_consensus, only_with_common_snip=True, set_slusters=None, R=None):
+    if R == None:
+        R = StRainyArgs().Rcl
     if set_slusters == None:
-        clusters = sorted(set(cl.loc[cl["Cluster"] != "NA","Cluster"].values))
+        clusters = cl.clusters()
     else:
         clusters = set_slusters
     try:
@@ -80,18 +82,112 @@ def build_adj_matrix_clusters(edge,cons,cl,flye_consensus, only_with_common_snip
     for i in sorted(sort, key = lambda sort: [sort[2], sort[1]]):
         sorted_by_pos.append(i[0])
     clusters = sorted(set(sorted_by_pos) & set(clusters), key = sorted_by_pos.index)
-    m = pd.DataFrame(-1.0, index = clusters, columns = clusters)
-
-    for i in range(0, m.shape[1]):
-        first_cl = m.index[i]
-        for k in range(i + 1, m.shape[1]):
-            second_cl = m.index[k]
-
-            if m[second_cl][first_cl] == -1:
-                m.loc[first_cl, second_cl] = matrix.distance_clusters(edge, first_cl, second_cl, cons, cl,flye_consensus, only_with_common_snip)
-                #m[second_cl][first_cl] = matrix.distance_clusters(edge, first_cl, second_cl, cons, cl,flye_consensus, only_with_common_snip)
-    return m
-
+    position = {cluster: i for i, cluster in enumerate(clusters)}
+
+    #pairs intersecting by less than I are never compared (distance_clusters returns 1 for them),
+    #so only the overlapping candidates are evaluated
+    m = np.full((len(clusters), len(clusters)), -1.0)
+    m[np.triu_indices(len(clusters), 1)] = 1.0
+    pairs = list(matrix.overlapping_cluster_pairs(clusters, cons, I))
+    #clearly distinct pairs are decided by their allele profiles, only the others are aligned.
+    #with R = 0 only an exact zero distance is an edge, which the profiles cannot tell
+    decided = {}
+    if profile_prescreen and R > 0:
+        decided = matrix.prescreen_pairs(pairs, cons, R, only_with_common_snip)
+        report_prescreen(edge, pairs, decided, cons, flye_consensus, only_with_common_snip)
+    remaining = [pair for pair in pairs if pair not in decided]
+    prefetch_consensus(edge, remaining, cons, cl, flye_consensus, only_with_common_snip)
+    for a, b in pairs:
+        first_cl, second_cl = (a, b) if position[a] < position[b] else (b, a)
+        if (a, b) in decided:
+            m[position[first_cl], position[second_cl]] = decided[(a, b)]
+        else:
+            m[position[first_cl], position[second_cl]] = matrix.distance_clusters(edge, first_cl, second_cl, cons, cl,flye_consensus, only_with_common_snip)
+    return pd.DataFrame(m, index = clusters, columns = clusters)
+
+
+
+def _polish_clusters(consensus_token, clusters, edge, cl):
+    flye_consensus = shared_object(consensus_token)
+    flye_consensus.flye_consensus_batch([(cluster, edge, cl) for cluster in clusters])
+
+
+def report_prescreen(edge, pairs, decided, cons, flye_consensus, only_with_common_snip=True):
+    """
+    Counts the consensus alignments and the polisher calls (consensuses that are not cached
+    and are no longer needed by any pair) avoided by the prescreen
+    """
+    if len(decided) == 0:
+        return
+    still_needed = set()
+    for first_cl, second_cl in pairs:
+        if (first_cl, second_cl) not in decided and matrix.alignment_needed(first_cl, second_cl, cons, only_with_common_snip):
+            still_needed.update((first_cl, second_cl))
+    avoided = {cluster for pair in decided for cluster in pair} - still_needed
+    avoided_polishing = sum(1 for cluster in avoided if not flye_consensus.has_consensus(cluster, edge))
+    logger.debug(f"Allele profiles decided {len(decided)} of {len(pairs)} cluster pairs of {edge}, "
+                 f"avoiding {avoided_polishing} polisher calls")
+    flye_consensus.add_statistic("prescreen_pairs", len(decided))
+    flye_consensus.add_statistic("prescreen_avoided_polishing", avoided_polishing)
+
+
+def prefetch_consensus(edge, pairs, cons, cl, flye_consensus, only_with_common_snip=True):
+    """
+    Polishes the consensuses that the pairs will be compared by in batches (one per idle worker,
+    if there are any), so that they are cached before the pairs are evaluated.
+    A batch job carries only the reads of its clusters, the workers refer to flye_consensus by its token
+    """
+    needed = set()
+    for first_cl, second_cl in pairs:
+        if matrix.alignment_needed(first_cl, second_cl, cons, only_with_common_snip):
+            needed.update((first_cl, second_cl))
+    missing = [cluster for cluster in sorted(needed) if not flye_consensus.has_consensus(cluster, edge)]
+    n_batches = min(len(missing), idle_helpers() + 1)
+    batches = [missing[i::n_batches] for i in range(n_batches)]
+    shared_map(_polish_clusters, [(flye_consensus.token, batch, edge, cl.subset(batch)) for batch in batches])
+
+
+def find_shortcut_edges(G, cutoff):
+    """
+    Returns the edges (u, v) of the cluster DAG for which there is also
+    a path from u to v of 2 to cutoff edges. For every node and depth d, the set of nodes
+    reachable within d edges is stored as an integer bitset, so the cost is
+    O(cutoff * E) bitset operations instead of enumerating all simple paths.
+    """
+    if not nx.is_directed_acyclic_graph(G):
+        raise nx.NetworkXUnfeasible("Cluster graph is expected to be a DAG")
+    nodes = list(G.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    successors = {node: list(G.successors(node)) for node in nodes}
+
+    #reach[node]: nodes reachable from node in 1..depth edges
+    reach = {node: 0 for node in nodes}
+    for _ in range(cutoff - 1):
+        next_reach = {}
+        for node in nodes:
+            bits = 0
+            for succ in successors[node]:
+                bits |= (1 << index[succ]) | reach[succ]
+            next_reach[node] = bits
+        reach = next_reach
+
+    shortcuts = []
+    for node in nodes:
+        longer_paths = 0
+        for succ in successors[node]:
+            longer_paths |= reach[succ]
+        for succ in successors[node]:
+            if longer_paths >> index[succ] & 1:
+                shortcuts.append((node, succ))
+    return shortcuts
+
+
+def find_branching_edges(G):
+    """
+    Returns the edges of the cluster DAG that leave a node with several
+    outgoing edges or enter a node with several incoming edges
+    """
+    return [(u, v) for u, v in G.edges() if G.out_degree(u) > 1 or G.in_degree(v) > 1]
 
 
 def join_clusters(cons, cl, Rcl, edge, consensus, only_with_common_snip=True,set_clusters=None, only_nested=False, transitive=False):
@@ -100,14 +196,14 @@ def join_clusters(cons, cl, Rcl, edge, consensus, only_with_common_snip=True,set
 
     if only_with_common_snip == False:
         if set_clusters == None:
-            M = build_adj_matrix_clusters(edge,cons, cl,consensus, False)
+            M = build_adj_matrix_clusters(edge,cons, cl,consensus, False, R=Rcl)
         else:
-            M = build_adj_matrix_clusters(edge, cons, cl, consensus, False,set_clusters)
+            M = build_adj_matrix_clusters(edge, cons, cl, consensus, False,set_clusters, R=Rcl)
     else:
         if set_clusters == None:
-            M = build_adj_matrix_clusters(edge,cons, cl,consensus, True)
+            M = build_adj_matrix_clusters(edge,cons, cl,consensus, True, R=Rcl)
         else:
-            M = build_adj_matrix_clusters(edge, cons, cl, consensus, True, set_clusters)
+            M = build_adj_matrix_clusters(edge, cons, cl, consensus, True, set_clusters, R=Rcl)
     M = matrix.change_w(M,Rcl)
 
     try:
@@ -125,32 +221,10 @@ def join_clusters(cons, cl, Rcl, edge, consensus, only_with_common_snip=True,set
         G_vis_before.draw("%s/graphs/linear_phase_%s.png" % (StRainyArgs().output_intermediate, edge))
         CUT_OFF=5
 
-    path_remove = []
-    for node in G_vis.nodes():
-        neighbors = nx.all_neighbors(G_vis, node)
-        for neighbor in list(neighbors):
-            for n_path in nx.algorithms.all_simple_paths(G_vis, node, neighbor, cutoff=CUT_OFF):
-                if len(n_path) >2:
-                    path_remove.append(n_path)
-
-    for n_path in path_remove:
-        try:
-            G_vis.remove_edge(n_path[0], n_path[len(n_path)-1])
-        except:
-            continue
-
-    lis = list(nx.topological_sort(nx.line_graph(G_vis)))
-    first = []
-    last = []
+    path_remove = find_shortcut_edges(G_vis, CUT_OFF)
+    G_vis.remove_edges_from(ebunch = path_remove)
 
-    for i in lis:
-        first.append(i[0])
-        last.append(i[1])
-
-    to_remove = []
-    for i in lis:
-        if first.count(i[0]) > 1 or last.count(i[1]) > 1:
-            to_remove.append(i)
+    to_remove = find_branching_edges(G_vis)
     G_vis.remove_edges_from(ebunch = to_remove)
 
     if StRainyArgs().debug and max(G_vis.number_of_nodes(), G_vis.number_of_edges()) < MAX_VIS_SIZE:
@@ -174,12 +248,11 @@ def join_clusters(cons, cl, Rcl, edge, consensus, only_with_common_snip=True,set
                 n_list.remove(nei)
                 n_list2.remove(node)
                 if (n_list==n_list2) is True:
-                    сlusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
                     new_cl_id = int(nei)+UNCLUSTERED_GROUP_N
-                    while new_cl_id in сlusters:
+                    while new_cl_id in cl:
                         new_cl_id = new_cl_id+1
-                    cl.loc[cl["Cluster"] == int(node), "Cluster"] =new_cl_id
-                    cl.loc[cl["Cluster"] == int(nei), "Cluster"] =new_cl_id
+                    cl.relabel(int(node), new_cl_id)
+                    cl.relabel(int(nei), new_cl_id)
 
                     G.remove_node(node)
                     G=nx.relabel_nodes(G,{nei:new_cl_id})
@@ -198,11 +271,7 @@ def join_clusters(cons, cl, Rcl, edge, consensus, only_with_common_snip=True,set
 
 
     else:
-        for n_path in path_remove:
-            try:
-                G.remove_edge(n_path[0], n_path[len(n_path)-1])
-            except :
-                continue
+        G.remove_edges_from(ebunch = path_remove)
         G.remove_edges_from(ebunch = to_remove)
 
         nested = {}
@@ -234,21 +303,49 @@ def join_clusters(cons, cl, Rcl, edge, consensus, only_with_common_snip=True,set
         if only_nested == True:
             for k,v in nested.items():
                 if len(v) == 1:
-                    cl.loc[cl["Cluster"] == int(k), "Cluster"] = int(v[0])
+                    cl.relabel(int(k), int(v[0]))
 
         else:
             for group in groups:
                 if len(group) > 1:
-                    сlusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
                     new_cl_id = int(list(group)[0])+UNCLUSTERED_GROUP_N
-                    while new_cl_id in сlusters:
+                    while new_cl_id in cl:
                         new_cl_id = new_cl_id+1
                     for i in range(0, len(group)):
-                        cl.loc[cl["Cluster"] == int(list(group)[i]), "Cluster"] = new_cl_id
+                        cl.relabel(int(list(group)[i]), new_cl_id)
     return cl
 
 
-def split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,type):
+class SplitBudget:
+    """
+    Per-unitig state of split_all: the (read set, SNP set) sub-problems that were
+    already split, and the number of split_cluster calls that are still allowed
+    """
+    def __init__(self, max_splits):
+        self.remaining = max_splits
+        self.seen = set()
+        self.exhausted = False
+
+    def try_take(self, cl, cluster, clSNP, edge):
+        #the sub-problem itself is stored, as different ones may have the same hash
+        key = (tuple(cl.members(cluster)), tuple(clSNP))
+        if key in self.seen:
+            logger.debug(f"Cluster {cluster} was already split with the same reads and SNPs, skipping")
+            return False
+        if self.remaining <= 0:
+            if not self.exhausted:
+                logger.warning(f"Split budget is exhausted for {edge}, the remaining clusters are not split")
+                self.exhausted = True
+            return False
+        self.seen.add(key)
+        return True
+
+
+def split_once(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,type, budget):
+    """
+    Splits a single cluster if it is marked as "Strange" ("Strange2" for lowheterozygosity type).
+    Returns the snapshot of clusters after the split, or an empty list if nothing was split.
+    """
     if type=="unclustered":
         factor="Strange"
         snp_set="clSNP"
@@ -256,55 +353,62 @@ def split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,typ
         factor="Strange2"
         snp_set="clSNP2"
 
-
-    if cons[cluster][factor] == 1:
-        clSNP = cons[cluster][snp_set]
-        res = split_cluster(cl, cluster, data,cons, clSNP, bam, edge, R, I)
-        new_cl_id_na=res[0]
-        clN =res[1]
-        build_data.cluster_consensuns(cl, new_cl_id_na, SNP_pos, data, cons, edge, reference_seq)
-
-        if clN != 0: #if clN==0 we dont need split NA cluster
-            split_cluster(cl, new_cl_id_na, data, cons,cons[new_cl_id_na][snp_set], bam, edge, R, I, False)
-        clusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
-
-        if clN == 1: #STOP LOOP IF EXIST
-            build_data.cluster_consensuns(cl, new_cl_id_na + clN, SNP_pos, data, cons, edge, reference_seq)
-
-        for cluster in clusters:
-            if cluster not in cons:
-                build_data.cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq)
-                split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,"unclustered")
-
-
-
-
+    if cons[cluster][factor] != 1:
+        return []
+    clSNP = cons[cluster][snp_set]
+    if not budget.try_take(cl, cluster, clSNP, edge):
+        return []
+
+    res = split_cluster(cl, cluster, data,cons, clSNP, bam, edge, R, I)
+    budget.remaining -= 1
+    new_cl_id_na=res[0]
+    clN =res[1]
+    build_data.cluster_consensuns(cl, new_cl_id_na, SNP_pos, data, cons, edge, reference_seq)
+
+    if clN != 0: #if clN==0 we dont need split NA cluster
+        split_cluster(cl, new_cl_id_na, data, cons,cons[new_cl_id_na][snp_set], bam, edge, R, I, False)
+        budget.remaining -= 1
+    clusters = cl.clusters()
+
+    if clN == 1: #STOP LOOP IF EXIST
+        build_data.cluster_consensuns(cl, new_cl_id_na + clN, SNP_pos, data, cons, edge, reference_seq)
+    return clusters
+
+
+def split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,type, budget):
+    """
+    Splits the cluster, and then (depth-first) every new cluster produced by the splits,
+    until no new clusters appear. Uses an explicit stack instead of recursion; repeated
+    sub-problems and the total amount of work are bounded by the SplitBudget
+    """
+    stack = [iter(split_once(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,type, budget))]
+    while stack:
+        cluster = next(stack[-1], None)
+        if cluster is None:
+            stack.pop()
+            continue
+        if cluster not in cons:
+            build_data.cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq)
+            stack.append(iter(split_once(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,"unclustered", budget)))
 
 
 def postprocess(bam, cl, SNP_pos, data, edge, R,Rcl, I, flye_consensus,mean_edge_cov):
     reference_seq = build_data.read_fasta_seq(StRainyArgs().fa, edge)
     cons = build_data.build_data_cons(cl, SNP_pos, data, edge, reference_seq)
+    split_budget = SplitBudget(max_split_operations)
     if StRainyArgs().debug:
         cl.to_csv("%s/clusters/%s_1.csv" % (StRainyArgs().output_intermediate, edge))
-    clusters = sorted(set(cl.loc[cl["Cluster"] != "NA","Cluster"].values))
-
 
-
-    cl.loc[cl["Cluster"] == "NA", "Cluster"] = UNCLUSTERED_GROUP_N
     build_data.cluster_consensuns(cl, UNCLUSTERED_GROUP_N, SNP_pos, data, cons, edge, reference_seq)
     clSNP = cons[UNCLUSTERED_GROUP_N]["clSNP2"]
     splitna = split_cluster(cl, UNCLUSTERED_GROUP_N, data, cons, clSNP, bam, edge, R, I,False)
 
     #Remove unclustered reads after splitting NA cluster
-    splitna[0]
-    cl = cl[cl["Cluster"] != splitna[0]]
-
-    cl = cl[cl["Cluster"] != UNCLUSTERED_GROUP_N]
-    clusters = sorted(set(cl.loc[cl["Cluster"] != splitna[0], "Cluster"].values))
-    clusters = sorted(set(cl.loc[cl["Cluster"] != UNCLUSTERED_GROUP_N, "Cluster"].values))
+    cl.remove(splitna[0])
+    cl.remove(UNCLUSTERED_GROUP_N)
+    clusters = cl.clusters()
 
     build_data.cluster_consensuns(cl, UNCLUSTERED_GROUP_N, SNP_pos, data, cons, edge, reference_seq)
-    counts = cl["Cluster"].value_counts(dropna = False)
 
     for cluster in clusters:
         if cluster not in cons:
@@ -313,40 +417,34 @@ def postprocess(bam, cl, SNP_pos, data, edge, R,Rcl, I, flye_consensus,mean_edge
     cl = join_clusters(cons, cl, Rcl, edge, flye_consensus)
     cons = build_data.build_data_cons(cl, SNP_pos, data, edge, reference_seq)
 
-    clusters = sorted(set(cl.loc[cl["Cluster"] != "NA","Cluster"].values))
+    clusters = cl.clusters()
     prev_clusters = clusters
     for cluster in clusters:
-        split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,"unclustered")
-        clusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
+        split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,"unclustered", split_budget)
+        clusters = cl.clusters()
         new_clusters = list(set(clusters) - set(prev_clusters))
         prev_clusters = clusters
         cl= join_clusters(cons, cl, Rcl, edge, flye_consensus, False,new_clusters,only_nested=False)
-        clusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
+        clusters = cl.clusters()
 
         for cluster in clusters:
             if cluster not in cons:
                 build_data.cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq)
-    clusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
+    clusters = cl.clusters()
 
     logging.info("Split stage2: Break regions of low heterozygosity")
     for cluster in clusters:
-        split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,"lowheterozygosity")
+        split_all(cl, cluster, data, cons,bam, edge, R, I, SNP_pos,reference_seq,"lowheterozygosity", split_budget)
 
 
-
-
-    cl.loc[cl["Cluster"] == "NA", "Cluster"] = UNCLUSTERED_GROUP_N
     build_data.cluster_consensuns(cl, UNCLUSTERED_GROUP_N, SNP_pos, data, cons, edge, reference_seq)
     clSNP = cons[UNCLUSTERED_GROUP_N]["clSNP2"]
     splitna = split_cluster(cl, UNCLUSTERED_GROUP_N, data, cons, clSNP, bam, edge, R, I,False)
     
     #Remove unclustered reads after splitting NA cluster
-    splitna[0]
-    cl = cl[cl["Cluster"] != splitna[0]]
-
-    cl = cl[cl["Cluster"] != UNCLUSTERED_GROUP_N]
-    clusters = sorted(set(cl.loc[cl["Cluster"] != splitna[0], "Cluster"].values))
-    clusters = sorted(set(cl.loc[cl["Cluster"] != UNCLUSTERED_GROUP_N, "Cluster"].values))
+    cl.remove(splitna[0])
+    cl.remove(UNCLUSTERED_GROUP_N)
+    clusters = cl.clusters()
 
     cl=update_cluster_set(cl, cluster, SNP_pos, data, cons, edge, reference_seq,mean_edge_cov)
 
@@ -357,8 +455,7 @@ def postprocess(bam, cl, SNP_pos, data, edge, R,Rcl, I, flye_consensus,mean_edge
     cl = join_clusters(cons, cl, Rcl, edge, flye_consensus)
     cl=update_cluster_set(cl, cluster, SNP_pos, data, cons, edge, reference_seq,mean_edge_cov,fraction=0.05)
     cl = join_clusters(cons, cl, Rcl, edge, flye_consensus, only_with_common_snip=False,only_nested=True)
-    counts = cl["Cluster"].value_counts(dropna = False)
-    cl = cl[~cl["Cluster"].isin(counts[counts < 6].index)]  #TODO change for cov*01.
+    cl.remove_small(6)  #TODO change for cov*01.
     cl=update_cluster_set(cl, cluster, SNP_pos, data, cons, edge, reference_seq,mean_edge_cov,fraction=0.05)
     return cl
 
@@ -366,14 +463,14 @@ def postprocess(bam, cl, SNP_pos, data, edge, R,Rcl, I, flye_consensus,mean_edge
 
 def update_cluster_set(cl, cluster, SNP_pos, data, cons, edge, reference_seq,mean_edge_cov,fraction=0.01):
     #Update consensus and remove small clusters (less 5% of unitig coverage)
-    clusters = sorted(set(cl.loc[cl["Cluster"] != "NA", "Cluster"].values))
+    clusters = cl.clusters()
     for cluster in clusters:
         if cluster not in cons:
             build_data.cluster_consensuns(cl, cluster, SNP_pos, data, cons, edge, reference_seq)
 
     for cluster in clusters:
         if cons[cluster]['Cov']<mean_edge_cov*fraction:
-            cl = cl[cl["Cluster"] !=cluster]
+            cl.remove(cluster)
 
 
     return cl
@@ -12,11 +12,11 @@ import os
 from strainy.params import *
 
 
-def write_bam(edge, I, AF):
-    infile = pysam.AlignmentFile(StRainyArgs().bam, "rb")
-    outfile = pysam.AlignmentFile("%s/bam/coloredBAM_unitig_%s.bam" % (StRainyArgs().output_intermediate, edge), "wb", template=infile)
+def read_colors(edge, I, AF):
+    """
+    Returns the colour tag of every read of the edge (by name), by its cluster in the clusters csv of phase
+    """
     cl = pd.read_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, AF),keep_default_na=False)
-    iter = infile.fetch(edge,until_eof=True)
     cmap = plt.get_cmap("viridis")
     cl.loc[cl["Cluster"] == "NA", "Cluster"] = 0
     clusters=sorted(set(cl["Cluster"].astype(int)))
@@ -31,22 +31,31 @@ def write_bam(edge, I, AF):
     for cluster in clusters:
         colors[cluster] = mt.colors.to_hex(cmap[i])
         i = i+1
-    cl_dict = dict(zip(cl.ReadName, cl.Cluster))
-
-    for read in iter:
-        try:
-            clN = int(cl_dict[str(read).split()[0]])
-            tag = colors[clN]
-            read.set_tag("YC", tag, replace=False)
-            outfile.write(read)
-        except (KeyError):
-            continue
-    outfile.close()
+    return {str(read_name): colors[int(cluster)] for read_name, cluster in zip(cl.ReadName, cl.Cluster)}
 
 
-def color(edge):
-    try:
-        write_bam(edge, I, StRainyArgs().AF)
-    except (FileNotFoundError):
-        pass
+def write_phased_bam(edges, output_file, threads=1):
+    """
+    Writes the reads of the phased edges with the colour of their cluster (YC tag) in a single pass
+    over the input bam. The input is coordinate-sorted, so the output is as well and is indexed directly.
+    Reads of the edges without clusters, and reads that are not in any cluster, are skipped
+    """
+    edge_colors = {}
+    for edge in edges:
+        try:
+            edge_colors[edge] = read_colors(edge, I, StRainyArgs().AF)
+        except (FileNotFoundError):
+            pass
 
+    infile = pysam.AlignmentFile(StRainyArgs().bam, "rb")
+    with pysam.AlignmentFile(output_file, "wb", template=infile, threads=threads) as outfile:
+        for edge in [name for name in infile.references if name in edge_colors]:
+            colors = edge_colors[edge]
+            for read in infile.fetch(edge):
+                tag = colors.get(read.query_name)
+                if tag is None:
+                    continue
+                read.set_tag("YC", tag, replace=False)
+                outfile.write(read)
+    infile.close()
+    pysam.index(output_file, "-@", str(threads))
@@ -0,0 +1,212 @@
+import os
+import mmap
+import pickle
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger()
+
+
+def consensus_key(edge, edge_digest, reads, mode, polisher_version):
+    """
+    Content address of a cluster consensus: it depends only on the read alignments (name, position,
+    cigar and sequence), the edge sequence, the read type and the polisher version,
+    and not on the cluster numbering of a run, so a realigned bam does not reuse the old consensuses
+    """
+    h = hashlib.sha1()
+    h.update(f"{edge}\t{edge_digest}\t{mode}\t{polisher_version}\n".encode())
+    for read in sorted(reads, key=lambda read: (read.query_name, read.reference_start)):
+        h.update(f"{read.query_name}\t{read.reference_start}\t{read.cigarstring}\t{read.query_sequence or ''}\n".encode())
+    return h.hexdigest()
+
+
+class PersistentConsensusCache:
+    """
+    On-disk store of consensus records shared between runs (and between the workers of a run).
+    Every record is a separate file named by its content key, written atomically.
+    Reading a record refreshes its modification time, and the least recently used
+    records are removed by evict() when the store is larger than max_bytes.
+    """
+    def __init__(self, path, max_bytes):
+        self._path = path
+        self._max_bytes = max_bytes
+        os.makedirs(self._path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self._path, key[:2], key + ".pkl")
+
+    def get(self, key):
+        filename = self._file(key)
+        try:
+            with open(filename, "rb") as f:
+                record = pickle.load(f)
+            os.utime(filename)
+            return record
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError, OSError):
+            logger.debug(f"Ignoring damaged consensus cache record {filename}")
+            return None
+
+    def put(self, key, record):
+        filename = self._file(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(record, f)
+            os.replace(tmp_name, filename)
+        except OSError:
+            logger.warning(f"Could not write consensus cache record {filename}")
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+    def evict(self):
+        """
+        Removes the least recently used records until the store fits into max_bytes
+        """
+        records = []
+        total = 0
+        for root, _, files in os.walk(self._path):
+            for name in files:
+                if not name.endswith(".pkl"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                records.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                total += stat.st_size
+
+        removed = 0
+        for _, size, filename in sorted(records):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Evicted {removed} records from the consensus cache {self._path}")
+
+
+#open log files and indexes of the current process, by log directory
+_log_writers = {}
+_log_writers_lock = threading.Lock()
+_log_readers = {}
+_ENTRY_HEADER = struct.Struct("<IQ")
+
+
+class ConsensusLog:
+    """
+    Append-only store of the consensus records of a run, written while they are computed.
+    Every process appends to its own file in the log directory, an entry is
+    (key length, record length, key, pickled record), so a crash keeps all complete entries.
+    The logs are read through memory maps: the entry headers are scanned once per process
+    to index the keys, and a record is unpickled only when it is looked up.
+    Entries of the same key are equivalent (the same consensus computed twice), any of them can be returned.
+    """
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(self._path, exist_ok=True)
+
+    def exists(self):
+        return any(name.endswith(".log") for name in os.listdir(self._path))
+
+    def clear(self):
+        for name in os.listdir(self._path):
+            if name.endswith(".log"):
+                os.remove(os.path.join(self._path, name))
+
+    def append(self, key, record):
+        """
+        Appends the record to the file of the current process. Only the threads of the process
+        write to it, so no lock shared with the other processes is needed
+        """
+        key = key.encode()
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with _log_writers_lock:
+            writer = _log_writers.get(self._path)
+            if writer is None or writer[0] != os.getpid():
+                writer = (os.getpid(), open(os.path.join(self._path, f"consensus_{os.getpid()}.log"), "ab"))
+                _log_writers[self._path] = writer
+            writer[1].write(_ENTRY_HEADER.pack(len(key), len(payload)) + key + payload)
+            writer[1].flush()
+
+    def _index(self):
+        reader = _log_readers.get(self._path)
+        if reader is None or reader[0] != os.getpid():
+            maps = []
+            index = {}
+            for name in sorted(os.listdir(self._path)):
+                filename = os.path.join(self._path, name)
+                if not name.endswith(".log") or os.path.getsize(filename) == 0:
+                    continue
+                with open(filename, "rb") as f:
+                    log_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                offset = 0
+                while offset + _ENTRY_HEADER.size <= len(log_map):
+                    key_length, record_length = _ENTRY_HEADER.unpack_from(log_map, offset)
+                    record_start = offset + _ENTRY_HEADER.size + key_length
+                    if record_start + record_length > len(log_map):
+                        logger.warning(f"Ignoring the truncated end of the consensus log {filename}")
+                        break
+                    key = bytes(log_map[offset + _ENTRY_HEADER.size:record_start]).decode()
+                    index[key] = (len(maps), record_start, record_length)
+                    offset = record_start + record_length
+                maps.append(log_map)
+            reader = (os.getpid(), maps, index)
+            _log_readers[self._path] = reader
+        return reader
+
+    def __contains__(self, key):
+        return key in self._index()[2]
+
+    def __len__(self):
+        return len(self._index()[2])
+
+    def get(self, key):
+        _, maps, index = self._index()
+        if key not in index:
+            return None
+        map_id, record_start, record_length = index[key]
+        return pickle.loads(maps[map_id][record_start:record_start + record_length])
+
+
+class LocalLRUCache:
+    """
+    In-process cache in front of the shared consensus store, bounded by the (estimated)
+    size of its values: the least recently used values are removed when it is full
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._values = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+                return value[0]
+            return None
+
+    def put(self, key, value, n_bytes):
+        if n_bytes > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._values:
+                self._bytes -= self._values.pop(key)[1]
+            self._values[key] = (value, n_bytes)
+            self._bytes += n_bytes
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_bytes) = self._values.popitem(last=False)
+                self._bytes -= evicted_bytes
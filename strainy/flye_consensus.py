@@ -1,13 +1,19 @@
+import re
 import gzip
+import bisect
+import hashlib
 import traceback
 import subprocess
 import os
 import shutil
-import random
 import logging
 import sys
+import uuid
+from array import array
+from collections import Counter
 
 import edlib
+import numpy as np
 import pysam
 from Bio import SeqIO
 from Bio.Seq import Seq
@@ -15,43 +21,206 @@ from Bio.SeqRecord import SeqRecord
 from argparse import Namespace
 
 from strainy.params import *
+from strainy.reference_store import get_reference_store
+from strainy.consensus_store import PersistentConsensusCache, LocalLRUCache, consensus_key
+from strainy.pileup_consensus import pileup_consensus
+from strainy.scratch_space import ScratchSpace
+from strainy.work_queue import share_object
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG)
 
 from flye.main import _run_polisher_only
+from flye.__version__ import __version__ as flye_version
+
+_ALIGNMENT_SYMBOLS = np.frombuffer(b"-.|", dtype=np.uint8)
+
+#local caches and statistics of the FlyeConsensus objects in the current process, by object token
+_local_state = {}
+
+
+def _gap_prefix(aligned):
+    """
+    Number of gaps in aligned[:i] for every i in 0..len(aligned)
+    """
+    gaps = np.frombuffer(aligned.encode(), dtype=np.uint8) == ord('-')
+    return np.concatenate(([0], np.cumsum(gaps)))
+
+
+_CIGAR_OPS = re.compile(r"(\d+)([=XID])")
+
+
+def _cigar_coordinate_map(cigar):
+    """
+    Maps the bases of the query of an extended edlib CIGAR (consensus) to the target (reference):
+    element t (t >= 1) is the 1-based position on the target of the column holding the t-th query base
+    (the number of target bases before that column + 1). Element 0 is 1 if the alignment starts
+    with a query gap and -1 otherwise, as for a zero base count in the gapped alignment strings
+    """
+    ops = _CIGAR_OPS.findall(cigar)
+    lengths = np.array([int(n) for n, _ in ops], dtype=np.int64)
+    codes = np.array([op for _, op in ops], dtype="U1")
+    if len(ops) == 0:
+        return np.array([-1], dtype=np.int64)
+    columns = np.repeat(codes, lengths)
+    is_query_base = columns != "D"
+    target_before = np.concatenate(([0], np.cumsum(columns != "I")[:-1]))
+    first = 1 if codes[0] == "D" else -1
+    return np.concatenate(([first], target_before[is_query_base] + 1))
+
+
+def _coverage_at(positions, bed_file_content):
+    """
+    calculate_coverage for an array of positions
+    """
+    if not isinstance(bed_file_content, CoverageTrack):
+        bed_file_content = CoverageTrack.from_rows(bed_file_content)
+    if len(bed_file_content) == 0:
+        return np.zeros(len(positions), dtype=np.int64)
+    starts = np.frombuffer(bed_file_content.starts, dtype=np.int32)
+    ends = np.frombuffer(bed_file_content.ends, dtype=np.int32)
+    coverage = np.frombuffer(bed_file_content.coverage, dtype=np.int32)
+    i = np.searchsorted(ends, positions, side="left")
+    inside = i < len(ends)
+    inside[inside] = starts[i[inside]] <= positions[inside]
+    return np.where(inside, coverage[np.minimum(i, len(ends) - 1)], 0)
+
+
+class CoverageTrack:
+    """
+    Per-base coverage of a consensus, stored as the sorted (start, end, coverage) intervals
+    of the bed file in three arrays, so that a position is looked up by binary search
+    """
+    __slots__ = ("starts", "ends", "coverage")
+
+    def __init__(self, starts, ends, coverage):
+        self.starts = array("i", starts)
+        self.ends = array("i", ends)
+        self.coverage = array("i", coverage)
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = sorted(rows)
+        return cls([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def at(self, position):
+        """
+        Coverage of the first interval containing the position (both ends inclusive), None if there is none
+        """
+        i = bisect.bisect_left(self.ends, position)
+        if i < len(self.starts) and self.starts[i] <= position:
+            return self.coverage[i]
+        return None
+
+
+class ConsensusRecord:
+    """
+    Consensus of a cluster, as stored in the consensus cache: the sequence clipped to [start, end)
+    of the edge, the limits of the cluster reads on the edge and the coverage track of the consensus.
+    The edge is kept by name, its sequence is in the reference store.
+    Fields are also accessible as record["consensus"], like the dicts of the earlier versions.
+    """
+    __slots__ = ("edge", "consensus", "start", "end", "read_starts", "read_ends", "bed_content")
+
+    def __init__(self, edge, consensus, start, end, read_limits=(), bed_content=None):
+        self.edge = edge
+        self.consensus = str(consensus)
+        self.start = start
+        self.end = end
+        self.read_starts = array("i", [read_start for read_start, _ in read_limits])
+        self.read_ends = array("i", [read_end for _, read_end in read_limits])
+        self.bed_content = bed_content if bed_content is not None else CoverageTrack([], [], [])
+
+    @property
+    def read_limits(self):
+        return list(zip(self.read_starts, self.read_ends))
+
+    def __getitem__(self, name):
+        if name not in self.__slots__ and name != "read_limits":
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def nbytes(self):
+        """
+        Approximate memory taken by the record
+        """
+        return len(self.consensus) + 4 * (2 * len(self.read_starts) + 3 * len(self.bed_content)) + 200
+
+    @classmethod
+    def load(cls, record, edge=None):
+        """
+        Converts the consensus dicts of consensus_dict.pkl (or of the persistent cache)
+        written by the earlier versions, records are returned as is
+        """
+        if isinstance(record, cls):
+            return record
+        bed_content = record.get('bed_content')
+        if bed_content is not None and not isinstance(bed_content, CoverageTrack):
+            bed_content = CoverageTrack.from_rows(bed_content)
+        return cls(edge, record['consensus'], record['start'], record['end'],
+                   record.get('read_limits', ()), bed_content)
+
+
+def load_consensus_dict(consensus_dict):
+    """
+    Converts a loaded consensus dictionary ("{cluster}-{edge}" -> consensus) to ConsensusRecord values
+    """
+    return {key: ConsensusRecord.load(record, key.split("-", 1)[-1]) for key, record in consensus_dict.items()}
+
 
 def calculate_coverage(position, bed_file_content):
     """
     Calculates and returns the coverage for a given position that is relative to the reference seq, not the aligment
     string
     """
-    for row in bed_file_content:
-        # row = [interval_start, interval_end, coverage]
-        if row[0] <= position <= row[1]:
-            return row[2]
+    if isinstance(bed_file_content, CoverageTrack):
+        coverage = bed_file_content.at(position)
+        if coverage is not None:
+            return coverage
+    else:
+        for row in bed_file_content:
+            # row = [interval_start, interval_end, coverage]
+            if row[0] <= position <= row[1]:
+                return row[2]
     logger.debug("Coordinate not found in .bed file, assuming coverage is 0")
     return 0
 
 
 class FlyeConsensus:
     def __init__(self, bam_file_name, graph_fasta_name, num_processes, consensus_dict, multiproc_manager,
-                indel_block_length_leniency=5):
+                indel_block_length_leniency=5, backend=None, consensus_log=None, saved_consensus=None):
 
         self._lock = multiproc_manager.Lock()
 
-        self._consensus_dict = multiproc_manager.dict(consensus_dict)
+        self._consensus_dict = multiproc_manager.dict(load_consensus_dict(consensus_dict))
+        #new consensuses are appended to consensus_log, saved_consensus is the log of an earlier stage
+        self._consensus_log = consensus_log
+        self._saved_consensus = saved_consensus
         self._alignment_cache= multiproc_manager.dict()
 
         self._bam_path = bam_file_name
-        self._read_index = None
-        self._unitig_seqs = {}
-        for seq in SeqIO.parse(graph_fasta_name, "fasta"):
-            self._unitig_seqs[str(seq.id)] = str(seq.seq)
+        self._bam_file = None
+        self._reference = get_reference_store(graph_fasta_name)
+        self._persistent_cache = PersistentConsensusCache(StRainyArgs().consensus_cache,
+                                                          int(StRainyArgs().consensus_cache_size * 1024 ** 3))
+        self._edge_digests = {}
+        self._scratch = ScratchSpace(StRainyArgs().scratch_dir, int(StRainyArgs().scratch_size * 1024 ** 3),
+                                     multiproc_manager)
 
         self._num_processes = num_processes
         self._indel_block_length_leniency = indel_block_length_leniency
         self._coverage_limit = min_consensus_cov[StRainyArgs().mode]
+        self._divergence = consensus_divergence[StRainyArgs().mode]
+        self._backend = backend if backend is not None else consensus_backend[StRainyArgs().mode]
         if StRainyArgs().mode == "hifi":
             self._platform = "pacbio"
             self._read_type = "hifi"
@@ -61,72 +230,193 @@ class FlyeConsensus:
             self._read_type = "raw"
             self._mode = "--nano-raw"
 
-        self._key_hit = multiproc_manager.Value("i", 0)
-        self._key_miss = multiproc_manager.Value("i", 0)
+        #the caches and the statistics of every process are local (see _local),
+        #the statistics are added to the shared ones by flush_statistics
+        self._token = uuid.uuid4().hex
+        self._statistics = multiproc_manager.dict()
+        share_object(self._token, self)
 
-        self._debug_count = multiproc_manager.Value("i", 0)
-        self._call_count = multiproc_manager.Value("i", 0)
 
+    def __getstate__(self):
+        #the bam file is reopened lazily in every process
+        state = self.__dict__.copy()
+        state["_bam_file"] = None
+        return state
 
-        self._position_hit = multiproc_manager.Value("i", 0)
-        self._position_miss = multiproc_manager.Value("i", 0)
 
-        self._alignment_cache_hit = multiproc_manager.Value("i", 0)
-        self._alignment_cache_miss = multiproc_manager.Value("i", 0)
+    def __setstate__(self, state):
+        #the shared jobs of the process refer to the object by its token
+        self.__dict__.update(state)
+        share_object(self._token, self)
 
 
-    def get_consensus_dict(self):
-        return self._consensus_dict.copy()
+    @property
+    def token(self):
+        return self._token
 
 
-    def print_cache_statistics(self):
-        logger.info(f"Total number of key hits and misses for consensus computation:")
-        logger.info(f" H:{self._key_hit.value}, M:{self._key_miss.value}")
-        logger.info(f"Position hit/miss")
-        logger.info(f" H:{self._position_hit.value}, M:{self._position_miss.value}")
-        logger.info(f"Alignment cache hit/miss")
-        logger.info(f" H:{self._alignment_cache_hit.value}, M:{self._alignment_cache_miss.value}")
+    def _local(self):
+        """
+        Returns the local cache and statistics of the current process
+        """
+        state = _local_state.get(self._token)
+        if state is None or state[0] != os.getpid():
+            state = (os.getpid(), LocalLRUCache(local_cache_size), Counter())
+            _local_state[self._token] = state
+        return state[1], state[2]
+
+
+    def _count(self, name, n=1):
+        self._local()[1][name] += n
+
+
+    def add_statistic(self, name, n):
+        self._count(name, n)
 
 
-    def _extract_reads(self, read_names, start_pos, output_file, edge=""):
+    def flush_statistics(self):
         """
-        based on the code by Tim Stuart https://timoast.github.io/blog/2015-10-12-extractreads/
-        Extract the reads given query names to a new bam file
+        Adds the statistics of the current process to the shared ones
         """
-        cluster_start = -1
-        cluster_end = -1
-        read_limits = []
+        statistics = self._local()[1]
+        if len(statistics) == 0:
+            return
+        with self._lock:
+            for name, n in statistics.items():
+                self._statistics[name] = self._statistics.get(name, 0) + n
+        statistics.clear()
+
+
+    def has_consensus(self, cluster, edge):
+        key = f"{cluster}-{edge}"
+        return key in self._consensus_dict or (self._saved_consensus is not None and key in self._saved_consensus)
+
+
+    def _lookup(self, key):
+        """
+        Returns the cached consensus of the key, or None
+        """
+        local_cache = self._local()[0]
+        record = local_cache.get(("consensus", key))
+        if record is not None:
+            return record
+        record = self._consensus_dict.get(key)
+        if record is None and self._saved_consensus is not None:
+            record = self._saved_consensus.get(key)
+            if record is not None:
+                record = ConsensusRecord.load(record, key.split("-", 1)[-1])
+        if record is not None:
+            local_cache.put(("consensus", key), record, record.nbytes())
+        return record
+
+
+    def _put(self, key, record):
+        with self._lock:
+            self._consensus_dict[key] = record
+        self._local()[0].put(("consensus", key), record, record.nbytes())
+        #the log files are per process, the writes do not hold the shared lock
+        if self._consensus_log is not None:
+            self._consensus_log.append(key, record)
 
-        read_list = []  # stores the reads to be written after the cluster start/end is calculated
 
-        if self._read_index is None:
-            self._read_index = pysam.IndexedReads(pysam.AlignmentFile(self._bam_path, "rb"))
-            self._read_index.build()
+    def cleanup_scratch(self):
+        if delete_flye_files:
+            self._scratch.cleanup()
+
+
+    def evict_persistent_cache(self):
+        self._persistent_cache.evict()
+
+
+    def _content_key(self, edge, read_list):
+        if edge not in self._edge_digests:
+            self._edge_digests[edge] = hashlib.sha1(self._reference.fetch(edge).encode()).hexdigest()
+        return consensus_key(edge, self._edge_digests[edge], read_list,
+                             f"{self._platform}-{self._read_type}-{self._backend}", flye_version)
+
+
+    def get_consensus_dict(self):
+        return self._consensus_dict.copy()
 
-        for i, name in enumerate(read_names):
-            iterator = self._read_index.find(name)
-            for x in iterator:
-                if x.reference_name == edge and x.reference_start == start_pos[i]:
-                    if x.reference_start < cluster_start or cluster_start == -1:
-                        cluster_start = x.reference_start
-                    if x.reference_end > cluster_end or cluster_end == -1:
-                        cluster_end = x.reference_end
-                    read_list.append(x)
-                    read_limits.append((x.reference_start, x.reference_end))
 
-        out = pysam.Samfile(output_file, "wb", template=pysam.AlignmentFile(self._bam_path, "rb"))
-        for x in read_list:
-            temp_dict = x.to_dict()
-            temp_dict["ref_pos"] = str(int(temp_dict["ref_pos"]) - cluster_start)
-            y = x.from_dict(temp_dict, x.header)  # create a new read from the modified dictionary
-            out.write(y)
+    def print_cache_statistics(self):
+        self.flush_statistics()
+        statistics = self._statistics.copy()
+        logger.info(f"Total number of key hits and misses for consensus computation:")
+        logger.info(f" H:{statistics.get('key_hit', 0)}, M:{statistics.get('key_miss', 0)}")
+        logger.info(f"Misses found in the persistent consensus cache: {statistics.get('persistent_hit', 0)}")
+        logger.info(f"Position hit/miss")
+        logger.info(f" H:{statistics.get('position_hit', 0)}, M:{statistics.get('position_miss', 0)}")
+        logger.info(f"Alignment cache hit/miss")
+        logger.info(f" H:{statistics.get('alignment_cache_hit', 0)}, M:{statistics.get('alignment_cache_miss', 0)}")
+        logger.info(f"Cluster pairs decided by allele profiles: {statistics.get('prescreen_pairs', 0)}, "
+                    f"polisher calls avoided: {statistics.get('prescreen_avoided_polishing', 0)}")
 
-        out.close()
 
-        return cluster_start, cluster_end, read_limits
+    def _extract_reads(self, edge, clusters):
+        """
+        Finds the alignments of the reads of every cluster to the edge (by query name and start position)
+        in a single pass over the edge region of the bam file.
+        clusters: list of (read names, read start positions)
+        Returns (cluster_start, cluster_end, read_limits, read_list) for every cluster, the reads are sorted by position
+        """
+        if self._bam_file is None:
+            self._bam_file = pysam.AlignmentFile(self._bam_path, "rb")
+
+        owner = {}
+        for i, (read_names, start_pos) in enumerate(clusters):
+            for name, start in zip(read_names, start_pos):
+                owner[(name, start)] = i
+
+        extracted = [[-1, -1, [], []] for _ in clusters]
+        for x in self._bam_file.fetch(edge):
+            i = owner.get((x.query_name, x.reference_start))
+            if i is None:
+                continue
+            limits = extracted[i]
+            if x.reference_start < limits[0] or limits[0] == -1:
+                limits[0] = x.reference_start
+            if x.reference_end > limits[1] or limits[1] == -1:
+                limits[1] = x.reference_end
+            limits[2].append((x.reference_start, x.reference_end))
+            limits[3].append(x)
+
+        return [tuple(limits) for limits in extracted]
+
+
+    def _write_reads(self, contigs, output_file):
+        """
+        Writes the reads to a new uncompressed bam file, the reads of every cluster are written against
+        its own contig, which starts at the first read of the cluster. The reads of every contig are
+        sorted by position, so the file is coordinate-sorted and can be indexed directly.
+        contigs: list of (contig name, cluster_start, cluster_end, read_list)
+        """
+        header = self._bam_file.header.to_dict()
+        header["HD"] = {"VN": header.get("HD", {}).get("VN", "1.6"), "SO": "coordinate"}
+        header["SQ"] = [{"SN": contig, "LN": cluster_end - cluster_start}
+                        for contig, cluster_start, cluster_end, _ in contigs]
+
+        with pysam.AlignmentFile(output_file, "wbu", header=header) as out:
+            for tid, (_, cluster_start, _, read_list) in enumerate(contigs):
+                for x in read_list:
+                    #the mates are not on the contigs (and not used by the polisher), so they are not copied
+                    y = pysam.AlignedSegment(out.header)
+                    y.query_name = x.query_name
+                    y.flag = x.flag
+                    y.reference_id = tid
+                    y.reference_start = x.reference_start - cluster_start
+                    y.mapping_quality = x.mapping_quality
+                    y.cigartuples = x.cigartuples
+                    y.query_sequence = x.query_sequence
+                    y.query_qualities = x.query_qualities
+                    y.set_tags(x.get_tags(with_value_type=True))
+                    out.write(y)
     
 
-    def _clip_consensus_seq(self, sequence, read_limits, bed_contents, curr_start, coverage_limit):
+    def _clip_bounds(self, read_limits, coverage_limit):
+        """
+        The consensus is clipped to the part of the edge covered by at least coverage_limit reads of the cluster
+        """
         start_pos = sorted([start for (start, _) in read_limits])
         end_pos = sorted([end for (_, end) in read_limits], reverse=True)
 
@@ -136,76 +426,198 @@ class FlyeConsensus:
         except IndexError:
             new_start_pos = start_pos[0]
             new_end_pos = end_pos[0]
+        return new_start_pos, new_end_pos
+
 
+    def _clip_consensus_seq(self, sequence, read_limits, bed_contents, curr_start, coverage_limit):
+        new_start_pos, new_end_pos = self._clip_bounds(read_limits, coverage_limit)
         return new_start_pos, new_end_pos, sequence[new_start_pos - curr_start:new_end_pos - curr_start]
 
 
+    def consensus_bounds(self, clusters, edge, cl):
+        """
+        Returns the (start, end) of the consensuses of the clusters on the edge without polishing them:
+        they are taken from the cached consensuses, or derived from the read limits
+        as the consensuses are clipped after polishing
+        """
+        bounds = {}
+        missing = []
+        for cluster in clusters:
+            record = self._lookup(f"{cluster}-{edge}")
+            if record is not None:
+                bounds[cluster] = (record["start"], record["end"])
+            else:
+                missing.append(cluster)
+        if len(missing) == 0:
+            return bounds
+
+        extracted = self._extract_reads(edge, [(cl.reads(cluster), cl.starts(cluster)) for cluster in missing])
+        for cluster, (cluster_start, cluster_end, read_limits, _) in zip(missing, extracted):
+            if len(read_limits) == 0:
+                bounds[cluster] = (cluster_start, cluster_end)
+            else:
+                bounds[cluster] = self._clip_bounds(read_limits, 2)
+        return bounds
+
+
     def flye_consensus(self, cluster, edge, cl, debug=False):
         """
         Computes the Flye based consensus of a cluster of reads for a specific edge.
         cluster: id (int)
-        cl: dataframe with columns read_name and cluster(id)
+        cl: ClusterAssignment of the edge reads
         edge: edge name (str)
         """
         # check if the output for this cluster-edge pair exists in the cache
         consensus_dict_key = f"{cluster}-{edge}"
-        with self._lock:
-            if consensus_dict_key in self._consensus_dict:
-                self._key_hit.value += 1
-                return self._consensus_dict[consensus_dict_key]
-            self._key_miss.value += 1
-
-        # fetch the read names in this cluster and extract those reads to a new bam file to be used by the
-        # Flye polisher
-        reads_from_curr_cluster = cl.loc[cl["Cluster"] == cluster]["ReadName"].to_numpy()  # store read names
-        start_pos_of_reads = cl.loc[cl["Cluster"] == cluster]["Start"].to_numpy()
-        salt = random.randint(1000, 10000)
-        fprefix = "%s/flye_inputs/" % StRainyArgs().output_intermediate
-        bam_subset = f"{fprefix}{edge}_cluster_{cluster}_reads_{salt}.bam"
-        bam_subset_sorted = f"{fprefix}{edge}_cluster_{cluster}_reads_{salt}_sorted.bam"
-        cluster_start, cluster_end, read_limits = self._extract_reads(reads_from_curr_cluster, start_pos_of_reads,
-                                                                      bam_subset, edge)
-
-        logger.debug((f"CLUSTER:{cluster}, CLUSTER_START:{cluster_start}, CLUSTER_END:{cluster_end}, EDGE:{edge},"
-               f"# OF READS:{len(reads_from_curr_cluster)}"))
+        record = self._lookup(consensus_dict_key)
+        if record is not None:
+            self._count("key_hit")
+            return record
+        self._count("key_miss")
+
+        self._polish([(cluster, edge, cl)])
+        return self._lookup(consensus_dict_key)
+
+
+    def flye_consensus_batch(self, targets):
+        """
+        Computes the Flye based consensus of many clusters, polishing up to max_polish_batch
+        of the missing ones as separate contigs in a single polisher run.
+        targets: list of (cluster, edge, cl)
+        Returns the consensus dicts in the order of the targets
+        """
+        found = {}
+        missing = []
+        for cluster, edge, cl in targets:
+            record = self._lookup(f"{cluster}-{edge}")
+            if record is not None:
+                found[f"{cluster}-{edge}"] = record
+            else:
+                missing.append((cluster, edge, cl))
+        self._count("key_hit", len(targets) - len(missing))
+        self._count("key_miss", len(missing))
+
+        missing = list({f"{cluster}-{edge}": (cluster, edge, cl) for cluster, edge, cl in missing}.values())
+        for i in range(0, len(missing), max_polish_batch):
+            self._polish(missing[i:i + max_polish_batch])
+        return [found.get(f"{cluster}-{edge}") or self._lookup(f"{cluster}-{edge}") for cluster, edge, _ in targets]
+
+
+    def _polish(self, targets):
+        """
+        Runs the Flye polisher over the clusters of the targets (each of them is a separate contig),
+        or builds their pileup consensuses if it is the backend for the mode, and stores the consensuses in the cache
+        """
+        # fetch the read names in every cluster and find their alignments, the reads are extracted
+        # to a new bam file to be used by the Flye polisher
+        extracted = {}
+        for edge in dict.fromkeys(edge for _, edge, _ in targets):
+            edge_targets = [(cluster, cl) for cluster, target_edge, cl in targets if target_edge == edge]
+            edge_reads = self._extract_reads(edge, [(cl.reads(cluster), cl.starts(cluster)) for cluster, cl in edge_targets])
+            for (cluster, _), reads in zip(edge_targets, edge_reads):
+                extracted[(cluster, edge)] = reads
+
+        #consensuses of the same alignments computed by any run are taken from the persistent cache
+        content_keys = {}
+        remaining = []
+        for cluster, edge, cl in targets:
+            content_key = self._content_key(edge, extracted[(cluster, edge)][3])
+            record = self._persistent_cache.get(content_key)
+            if record is not None:
+                record = ConsensusRecord.load(record, edge)
+                self._count("persistent_hit")
+                self._put(f"{cluster}-{edge}", record)
+            else:
+                content_keys[(cluster, edge)] = content_key
+                remaining.append((cluster, edge, cl))
+        targets = remaining
+        if len(targets) == 0:
+            return
+
+        found = []
+        for cluster, edge, cl in targets:
+            key = f"{cluster}-{edge}"
+            cluster_start, cluster_end, read_limits, read_list = extracted[(cluster, edge)]
+            logger.debug((f"CLUSTER:{cluster}, CLUSTER_START:{cluster_start}, CLUSTER_END:{cluster_end}, EDGE:{edge},"
+                   f"# OF READS:{len(read_list)}"))
+            if len(read_list) == 0:
+                logger.warning(f"WARNING: no reads found for cluster {cluster} of {edge}, defaulting to empty sequence")
+                self._put(key, ConsensusRecord(edge, '', cluster_start, cluster_end))
+                continue
+            found.append((cluster, edge, key, cluster_start, cluster_end, read_limits, read_list))
+        if len(found) == 0:
+            return
+
+        if self._backend == "pileup":
+            for cluster, edge, key, cluster_start, cluster_end, read_limits, read_list in found:
+                sequence, coverage = pileup_consensus(self._reference.fetch(edge, cluster_start, cluster_end),
+                                                      read_list, cluster_start)
+                self._store_consensus(edge, key, content_keys[(cluster, edge)], sequence,
+                                      CoverageTrack.from_rows(coverage),
+                                      cluster_start, read_limits)
+            return
+
+        #the reads and the polisher outputs take a few bytes per read base in the scratch space
+        scratch_bytes = sum(read.query_length for found_target in found for read in found_target[6]) * scratch_bytes_per_base
+        with self._scratch.reserve(scratch_bytes):
+            polished = self._run_polisher(found)
+        if polished is None:
+            for _, edge, key, cluster_start, cluster_end, _, _ in found:
+                self._put(key, ConsensusRecord(edge, '', cluster_start, cluster_end))
+            return
+
+        consensus, bed_content = polished
+
+        for cluster, edge, key, cluster_start, cluster_end, read_limits, _ in found:
+            if key not in consensus:
+                logger.warning(f"WARNING: no polished sequence for cluster {cluster} of {edge}, defaulting to empty sequence")
+            self._store_consensus(edge, key, content_keys[(cluster, edge)], consensus.get(key, Seq('')),
+                                  bed_content.get(key, CoverageTrack([], [], [])), cluster_start, read_limits)
+
+
+    def _run_polisher(self, found):
+        """
+        Polishes the clusters of found in a single Flye polisher run, with the temporary files in the worker scratch directory.
+        Returns the polished sequences and the coverage tracks by contig ("{cluster}-{edge}"), None if the polisher failed
+        """
+        prefix = self._scratch.new_prefix()
+        bam_subset = f"{prefix}_reads.bam"
+        self._write_reads([(key, cluster_start, cluster_end, read_list)
+                           for _, _, key, cluster_start, cluster_end, _, read_list in found], bam_subset)
 
         # access the edge in the graph and cut its sequence according to the cluster start and end positions
-        # this sequence is written to a fasta file to be used by the Flye polisher
-        ref_seq_cut = self._unitig_seqs[edge][cluster_start:cluster_end]
-        fname = f"{fprefix}{edge}-cluster{cluster}-{salt}"
-        record = SeqRecord(
-            Seq(ref_seq_cut),
-            id=f"{edge}",
-            name=f"{edge} sequence cut for cluster {cluster}",
-            description=""
-        )
-        SeqIO.write([record], f"{fname}.fa", "fasta")
+        # these sequences are written to a fasta file to be used by the Flye polisher
+        records = []
+        for cluster, edge, key, cluster_start, cluster_end, _, _ in found:
+            records.append(SeqRecord(
+                Seq(self._reference.fetch(edge, cluster_start, cluster_end)),
+                id=key,
+                name=f"{edge} sequence cut for cluster {cluster}",
+                description=""
+            ))
+        fname = f"{prefix}_target"
+        SeqIO.write(records, f"{fname}.fa", "fasta")
 
         try:
-            # sort the bam file
-            pysam.sort("-o", bam_subset_sorted, bam_subset)
-            # index the bam file
-            pysam.index(bam_subset_sorted)
+            # index the bam file (it is written sorted)
+            pysam.index(bam_subset)
         except pysam.utils.SamtoolsError  as e:
-            logger.error(f'Error while sorting {bam_subset_sorted}')
+            logger.error(f'Error while indexing {bam_subset}')
             logger.error(traceback.format_exc())
 
         #  Polisher arguments for to call _run_polisher_only(polish_args)
-        flye_out_dir = f"{StRainyArgs().output_intermediate}/flye_outputs/flye_consensus_{edge}_{cluster}_{salt}"
+        flye_out_dir = f"{prefix}_flye"
         polish_args = Namespace(polish_target=f"{fname}.fa",
-                                reads=[bam_subset_sorted],
+                                reads=[bam_subset],
                                 out_dir=flye_out_dir,
                                 num_iters=1,
                                 threads=1,
                                 platform=self._platform,
                                 read_type=self._read_type)
 
-        # polish_cmd = f"{StRainyArgs().flye} --polish-target {fname}.fa --threads {self._num_processes}" \
-        #              f" {self._mode} {fprefix}cluster_{cluster}_reads_sorted_{salt}.bam " \
-        #              f"-o {StRainyArgs().output_intermediate}/flye_outputs/flye_consensus_{edge}_{cluster}_{salt}"
+        polished = None
         try:
-            logger.debug("Running Flye polisher")
-            # subprocess.check_output(polish_cmd, shell=True, capture_output=False, stderr=open(os.devnull, "w"))
+            logger.debug(f"Running Flye polisher for {len(found)} clusters")
             # TODO: this should move to the top when flye pull request is merged
             if not os.path.isdir(polish_args.out_dir):
                 os.mkdir(polish_args.out_dir)
@@ -214,61 +626,48 @@ class FlyeConsensus:
         except Exception as e:
             logger.error("Error running the Flye polisher. Make sure the fasta file contains only the primary alignments")
             logger.error(e)
-            with self._lock:
-                self._consensus_dict[consensus_dict_key] = {
-                    'consensus': Seq(''),
-                    'start': cluster_start,
-                    'end': cluster_end
-                }
-                return self._consensus_dict[consensus_dict_key]
+        else:
+            consensus = {}
+            try:
+                # read back the output of the Flye polisher
+                consensus = {record.id: record.seq for record in SeqIO.parse(os.path.join(flye_out_dir, "polished_1.fasta"), "fasta")}
+            except (ImportError, ValueError) as e:
+                # If there is an error, the sequence strings are set to empty by default
+                logger.warning("WARNING: error reading back the flye output, defaulting to empty sequence for consensus")
+                if type(e).__name__ == 'ImportError':
+                    logger.warning('found ImportError')
 
-        try:
-            # read back the output of the Flye polisher
-            consensus = SeqIO.read(os.path.join(flye_out_dir, "polished_1.fasta"), "fasta")
-        except (ImportError, ValueError) as e:
-            # If there is an error, the sequence string is set to empty by default
-            logger.warning("WARNING: error reading back the flye output, defaulting to empty sequence for consensus")
-            if type(e).__name__ == 'ImportError':
-                logger.warning('found ImportError')
-            consensus = SeqRecord(
-                seq=''
-            )
-
-        bed_content = self._parse_bed_coverage(os.path.join(flye_out_dir, "base_coverage.bed.gz"))
+            bed_content = self._parse_bed_coverage(os.path.join(flye_out_dir, "base_coverage.bed.gz"))
+            polished = consensus, bed_content
 
         # delete the created input files to Flye
         if delete_flye_files:
-            try:
-                os.remove(f"{fname}.fa")
-                os.remove(bam_subset)
-                os.remove(bam_subset_sorted)
-                os.remove(bam_subset_sorted + ".bai")
-                shutil.rmtree(flye_out_dir)
-            except (OSError, FileNotFoundError):
-                pass
-
-        start, end, consensus_clipped = self._clip_consensus_seq(consensus.seq, 
-                                                                 read_limits, 
+            for filename in (f"{fname}.fa", bam_subset, bam_subset + ".bai"):
+                try:
+                    os.remove(filename)
+                except (OSError, FileNotFoundError):
+                    pass
+            shutil.rmtree(flye_out_dir, ignore_errors=True)
+        return polished
+
+
+    def _store_consensus(self, edge, key, content_key, sequence, bed_content, cluster_start, read_limits):
+        start, end, consensus_clipped = self._clip_consensus_seq(sequence,
+                                                                 read_limits,
                                                                  bed_content,
                                                                  cluster_start,
                                                                  2)
-        with self._lock:
-            self._consensus_dict[consensus_dict_key] = {
-                'consensus': consensus_clipped,
-                'start': start,
-                'end': end,
-                'read_limits': read_limits,
-                'bam_path': bam_subset,
-                'reference_path': f"{fname}.fa",
-                'reference_seq': self._unitig_seqs[edge],
-                'bed_content': bed_content
+        record = ConsensusRecord(edge, consensus_clipped, start, end, read_limits, bed_content)
+        self._put(key, record)
+        self._persistent_cache.put(content_key, record)
 
-            }
-            return self._consensus_dict[consensus_dict_key]
 
-
-    def _edlib_align(self, seq_a, seq_b):
-        band_size = 32
+    def _edlib_path(self, seq_a, seq_b):
+        """
+        Global edlib alignment with the band estimated from the length difference and the expected
+        divergence of the consensuses, doubled if the edit distance does not fit into it
+        """
+        band_size = abs(len(seq_a) - len(seq_b)) + int(self._divergence * max(len(seq_a), len(seq_b))) + 32
         aln = None
         while True:
             aln = edlib.align(seq_a, seq_b, "NW", "path", band_size)
@@ -278,28 +677,35 @@ class FlyeConsensus:
                 band_size *= 2
             else:
                 break
-        #print("Band size", band_size)
+        return aln
+
+
+    def _edlib_align(self, seq_a, seq_b):
+        aln = self._edlib_path(seq_a, seq_b)
         nice = edlib.getNiceAlignment(aln, seq_a, seq_b)
         #note that target and query are swapped because the definition is edlib.align(query, target)
         return nice["query_aligned"], nice["target_aligned"], nice["matched_aligned"]
 
 
     def _parse_bed_coverage(self, filename):
-        contents = []
-        with gzip.open(filename, 'r') as f:
+        """
+        Returns the coverage track of every contig in the bed file
+        """
+        contents = {}
+        with gzip.open(filename, 'rt') as f:
             for line in f:
+                fields = line.strip().split()
                 try:
-                    contents.append(list(map(int, line.strip().split()[1:])))
-                except ValueError:
+                    contents.setdefault(fields[0], []).append(list(map(int, fields[1:])))
+                except (ValueError, IndexError):
                     pass
-        return contents
+        return {contig: CoverageTrack.from_rows(rows) for contig, rows in contents.items()}
 
 
     def _custom_scoring_function(self, aligned_first, alignment_string, aligned_second,
-                                first_to_ref, reference_to_first,
+                                first_to_ref_cigar,
                                 intersection_start, first_cl_dict, second_cl_dict,
                                 commonSNPs, first_cl_start):
-        info_printed = False
         """
         A custom distance scoring function for two sequences taking into account the artifacts of Flye consensus.
         alignment_string: a string consisting of '-', '.', '|' characters which correspond to indel, mismatch, match,
@@ -308,51 +714,54 @@ class FlyeConsensus:
         Indels are 1 point each if there are more than 5 of them in a contiguous block.
         Indel blocks start at the beginning or finish at the end are ignored.
         Variants that are covered by less than self._coverage_limits are assumed matches.
+        first_to_ref_cigar: edlib CIGAR of the alignment of the first consensus to the reference.
+        The gap counts and coverages are computed for all columns at once, and only the columns
+        that can change the indel block state (gaps and the columns following them) are visited one by one.
         """
         score = 0
         indel_length = 0
         indel_block_start = -1
-        alignment_list = list(alignment_string)
+
+        alignment = np.frombuffer(alignment_string.encode(), dtype=np.uint8)
+        if not np.isin(alignment, _ALIGNMENT_SYMBOLS).all():
+            raise Exception("Unknown alignment sybmol!")
+        is_gap = alignment == ord('-')
+        is_variant = is_gap | (alignment == ord('.'))
 
         first_shift = intersection_start - first_cl_dict['start']
         second_shift = intersection_start - second_cl_dict['start']
 
-        # read the contents of the bed.gz files that contain coverage information for each coordinate
-        # list of lists with (start, end, coverage) for each coordinate interval
-        cl1_bed_contents = first_cl_dict['bed_content']
-        cl2_bed_contents = second_cl_dict['bed_content']
-
-
-        for i, base in enumerate(alignment_list):
-            if base not in "-.|":
-                raise Exception("Unknown alignment sybmol!")
-
-            # true coordinate = current coordinate on the alignment_string
-            # + start of the intersection
-            # - gaps in the target (or query) sequence thus far
-            cl1_true_coor = first_shift + i - aligned_first[:i].count('-')
-            cl2_true_coor = second_shift + i - aligned_second[:i].count('-')
-
-            # ignore variants with low coverage
-            if ((base == '-' or base == '.')
-                    and (calculate_coverage(cl1_true_coor, cl1_bed_contents) < self._coverage_limit
-                    or calculate_coverage(cl2_true_coor, cl2_bed_contents) < self._coverage_limit)):
-                # TODO: this makes it a problem to calculate the true coordinate later on
-                base = '|'
-
-            if base == '-':
+        # true coordinate = current coordinate on the alignment_string
+        # + start of the intersection
+        # - gaps in the target (or query) sequence thus far
+        first_gaps = _gap_prefix(aligned_first)
+        variants = np.flatnonzero(is_variant)
+        cl1_true_coor = first_shift + variants - first_gaps[variants]
+        cl2_true_coor = second_shift + variants - _gap_prefix(aligned_second)[variants]
+
+        # ignore variants with low coverage
+        # TODO: this makes it a problem to calculate the true coordinate later on
+        low_coverage = np.zeros(len(alignment), dtype=bool)
+        low_coverage[variants] = ((_coverage_at(cl1_true_coor, first_cl_dict['bed_content']) < self._coverage_limit)
+                                  | (_coverage_at(cl2_true_coor, second_cl_dict['bed_content']) < self._coverage_limit))
+
+        after_gap = np.zeros(len(alignment), dtype=bool)
+        after_gap[1:] = is_gap[:-1]
+        last = len(alignment) - 1
+        for i in np.flatnonzero(is_gap | after_gap).tolist():
+            if is_gap[i] and not low_coverage[i]:
                 # ignore the indels at the first or last position
                 if i == 0:
                     indel_length = 1
                     indel_block_start = i
                     continue
-                elif i == (len(alignment_list) - 1):
+                elif i == last:
                     # trailing gaps are ignored
                     # break out of the loop without increasing the score
                     break
                 else:
                     # start of an indel block if previous base was not a gap
-                    if alignment_list[i - 1] != '-':
+                    if not after_gap[i]:
                         indel_block_start = i
                         indel_length = 1
                     # extend the indel block
@@ -360,43 +769,37 @@ class FlyeConsensus:
                         indel_length += 1
 
             # a contiguous gap ends if the previous base was a gap but not this one
-            elif i != 0 and alignment_list[i - 1] == '-':
+            elif after_gap[i]:
                 if (indel_length >= self._indel_block_length_leniency and
                         indel_block_start != 0):
                     score += indel_length
                 indel_length = 0
 
-            # mismatch
-            if base == '.':
-                if info_printed == False:
-                    info_printed = True
-                    # logger.info(f"common SNP positions for the unitig: {commonSNPs}")
-
-                mismatch_position = self._get_true_mismatch_position(
-                    aligned_first,
-                    first_to_ref,
-                    reference_to_first,
-                    i,
-                    intersection_start - first_cl_start
-                    ) + first_cl_start
-                
-                if mismatch_position in commonSNPs:
-                    self._position_hit.value += 1
-                    score += 1
-                else:
-                    self._position_miss.value += 1
+        # mismatches
+        mismatches = np.flatnonzero((alignment == ord('.')) & ~low_coverage)
+        if len(mismatches):
+            mismatch_positions = self._get_true_mismatch_position(
+                first_gaps,
+                first_to_ref_cigar,
+                mismatches,
+                intersection_start - first_cl_start
+                ) + first_cl_start
+            hits = int(np.isin(mismatch_positions, np.fromiter(commonSNPs, dtype=np.int64, count=len(commonSNPs))).sum())
+            self._count("position_hit", hits)
+            self._count("position_miss", len(mismatches) - hits)
+            score += hits
 
         return score
 
 
-    def _get_true_mismatch_position(self, cons_to_cons, cons_to_ref, reference, mismatch_index, first_cl_start):
+    def _get_true_mismatch_position(self, cons_to_cons_gaps, cons_to_ref_cigar, mismatch_index, first_cl_start):
 
         """ 
-        The following three are outputs of alignments and contain gaps:
-        cons_to_cons: consensus sequence aligned to another consensus sequence
-        cons_to_ref: same consensus sequence aligned to reference
-        reference: reference aligned to cons_to_ref
-        mismatch_index: index of the mismatch in cons_to_cons
+        cons_to_cons_gaps: number of gaps before every column of the consensus sequence
+        aligned to another consensus sequence (see _gap_prefix)
+        cons_to_ref_cigar: edlib CIGAR of the same consensus sequence aligned to reference
+        mismatch_index: array of the indices of the mismatches in cons_to_cons
+        Returns the array of the positions on the reference (-1 where it could not be found)
         """
 
         # TODO: this function may return a position that corresponds to a gap
@@ -404,24 +807,14 @@ class FlyeConsensus:
 
         # TODO: count mismatches too?
         # Find how many bases are there up to and including the mismatch_index
-        true_pos_cons_to_cons = mismatch_index - cons_to_cons[:mismatch_index].count('-') + first_cl_start + 1
-        
-        # Find the index of base from cons_to_cons in cons_to_ref
-        true_pos_cons_to_ref = -1
-        bases = 0 # number of bases so far
-        for i, b in enumerate(cons_to_ref):
-            if b != '-':
-                bases += 1
-            if bases == true_pos_cons_to_cons:
-                true_pos_cons_to_ref = i
-                break
+        true_pos_cons_to_cons = mismatch_index - cons_to_cons_gaps[mismatch_index] + first_cl_start + 1
 
-        # -1 indicates error
-        if true_pos_cons_to_ref == -1:
-            return true_pos_cons_to_ref
-        
-        # Find the true position of base matched with cons_to_ref in reference
-        return true_pos_cons_to_ref - reference[:true_pos_cons_to_ref].count('-') + 1
+        # Find the true position of the base on the reference (-1 indicates error)
+        coordinate_map = _cigar_coordinate_map(cons_to_ref_cigar)
+        found = (true_pos_cons_to_cons >= 0) & (true_pos_cons_to_cons < len(coordinate_map))
+        true_pos = np.full(len(mismatch_index), -1, dtype=np.int64)
+        true_pos[found] = coordinate_map[true_pos_cons_to_cons[found]]
+        return true_pos
 
 
     def cluster_distance_via_alignment(self, first_cl, second_cl, cl, edge, commonSNPs, debug=False):
@@ -430,14 +823,15 @@ class FlyeConsensus:
         intersecting parts of the consensus'.
         first_cl: id (int)
         second_cl: id (int)
-        cl: dataframe with columns 'read_name' and 'cluster' (id)
+        cl: ClusterAssignment of the edge reads
         edge: edge name (str)
         """
-        self._call_count.value += 1
+        statistics = self._local()[1]
+        statistics["call_count"] += 1
         if debug:
-            self._debug_count.value += 1
-        if self._debug_count.value > 0:
-            logger.debug(f"{self._debug_count.value}/{self._call_count.value} disagreements")
+            statistics["debug_count"] += 1
+        if statistics["debug_count"] > 0:
+            logger.debug(f"{statistics['debug_count']}/{statistics['call_count']} disagreements")
         first_cl_dict = self.flye_consensus(first_cl, edge, cl, debug)
         second_cl_dict = self.flye_consensus(second_cl, edge, cl, debug)
 
@@ -456,31 +850,29 @@ class FlyeConsensus:
             logger.debug(f'Intersection length for clusters is less than 1 for clusters {first_cl}, {second_cl} in {edge}')
             return 1
 
-        reference_seq = first_cl_dict['reference_seq']
         aligned_first, aligned_second, edlib_aln = self._edlib_align(first_consensus_clipped, second_consensus_clipped)
 
         
         # check if alignment to reference is already computed
         cache_key = f"{edge}-{first_cl}-{first_cl_dict['start']}-{first_cl_dict['end']}"
         
-        # Check if the result is already computed 
-        already_computed = False
-        with self._lock:
-            if cache_key in self._alignment_cache:
-                already_computed = True
-
-        if already_computed:
-            self._alignment_cache_hit.value += 1
-            with self._lock:
-                first_cl_to_ref, reference_aligned =  self._alignment_cache[cache_key]
+        # Check if the result is already computed, in this process or by any other
+        local_cache = self._local()[0]
+        first_cl_to_ref_cigar = local_cache.get(("alignment", cache_key))
+        if first_cl_to_ref_cigar is None:
+            first_cl_to_ref_cigar = self._alignment_cache.get(cache_key)
+
+        if first_cl_to_ref_cigar is not None:
+            self._count("alignment_cache_hit")
         else:
-            self._alignment_cache_miss.value += 1
-            first_cl_to_ref, reference_aligned, _ = self._edlib_align(first_cl_dict['consensus'], reference_seq[first_cl_dict['start']:first_cl_dict['end']])
-            # cache the reference alignment for re-use
-            with self._lock:
-                self._alignment_cache[cache_key] = [first_cl_to_ref, reference_aligned]
-
-        edlib_score = self._custom_scoring_function(aligned_first, edlib_aln, aligned_second, first_cl_to_ref, reference_aligned, intersection_start,
+            self._count("alignment_cache_miss")
+            first_cl_to_ref_cigar = self._edlib_path(first_cl_dict['consensus'],
+                                                     self._reference.fetch(edge, first_cl_dict['start'], first_cl_dict['end']))["cigar"]
+            # cache the reference alignment (its CIGAR only) for re-use
+            self._alignment_cache[cache_key] = first_cl_to_ref_cigar
+        local_cache.put(("alignment", cache_key), first_cl_to_ref_cigar, len(first_cl_to_ref_cigar) + 100)
+
+        edlib_score = self._custom_scoring_function(aligned_first, edlib_aln, aligned_second, first_cl_to_ref_cigar, intersection_start,
                                                     first_cl_dict, second_cl_dict, commonSNPs, first_cl_dict['start'])
         
         # score is not normalized!
@@ -0,0 +1,121 @@
+import mmap
+import logging
+
+
+logger = logging.getLogger()
+
+
+class Segment:
+    """
+    Detached copy of a single S line of a gfa: the name, the sequence and the optional tags.
+    The tags are available as attributes (segment.dp); as in gfapy, a missing tag is None
+    """
+    __slots__ = ("name", "sequence", "tags")
+
+    def __init__(self, name, sequence, tags):
+        self.name = name
+        self.sequence = sequence
+        self.tags = tags
+
+    def __getattr__(self, tag):
+        if tag.startswith("__") or tag in Segment.__slots__:
+            raise AttributeError(tag)
+        return self.tags.get(tag)
+
+    def __setattr__(self, key, value):
+        if key in Segment.__slots__:
+            object.__setattr__(self, key, value)
+        else:
+            self.tags[key] = value
+
+    @property
+    def length(self):
+        if self.sequence == "*":
+            return self.tags.get("LN")
+        return len(self.sequence)
+
+    @staticmethod
+    def parse(line):
+        fields = line.rstrip("\r\n").split("\t")
+        tags = {}
+        for field in fields[3:]:
+            tag, tag_type, value = field.split(":", 2)
+            if tag_type == "i":
+                value = int(value)
+            elif tag_type == "f":
+                value = float(value)
+            tags[tag] = value
+        return Segment(fields[1], fields[2], tags)
+
+
+class SegmentStore:
+    """
+    Random access to the segments of a gfa file without parsing the graph.
+    The file is memory-mapped and the offsets of the S lines are found with a single scan,
+    after that a segment is read and parsed independently of the size of the graph.
+    Only the path and the index are pickled, the mapping is re-opened lazily in every process
+    """
+    def __init__(self, gfa_path):
+        self._gfa_path = gfa_path
+        self._file = None
+        self._mmap = None
+        self._index = self._scan()
+
+    def __getstate__(self):
+        return {"_gfa_path": self._gfa_path, "_index": self._index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._file = None
+        self._mmap = None
+
+    def _open(self):
+        if self._mmap is None:
+            self._file = open(self._gfa_path, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _scan(self):
+        logger.debug(f"Indexing segments of {self._gfa_path}")
+        index = {}
+        data = self._open()
+        def next_segment(pos):
+            found = data.find(b"\nS\t", pos)
+            return None if found < 0 else found + 1
+
+        start = 0 if data[:2] == b"S\t" else next_segment(0)
+        while start is not None:
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = len(data)
+            name_end = data.find(b"\t", start + 2, end)
+            index[data[start + 2:name_end].decode()] = (start, end)
+            start = next_segment(end)
+        return index
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def names(self):
+        return list(self._index.keys())
+
+    def try_get_segment(self, name):
+        """
+        Returns a copy of the segment, or None if the gfa does not contain it.
+        The changes of the copy are not written to the file
+        """
+        if name not in self._index:
+            return None
+        start, end = self._index[name]
+        return Segment.parse(self._open()[start:end].decode("ascii"))
+
+
+_stores = {}
+
+def get_segment_store(gfa_path):
+    """
+    Per-process cache of the segment stores
+    """
+    if gfa_path not in _stores:
+        _stores[gfa_path] = SegmentStore(gfa_path)
+    return _stores[gfa_path]
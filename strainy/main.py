@@ -82,6 +82,24 @@ def main():
                         required=False,
                         type=int,
                         default=500)
+    parser.add_argument("--consensus-cache",
+                        help="Directory of the consensus cache, which can be shared between runs (default: <output>/consensus_cache)",
+                        required=False,
+                        default=None)
+    parser.add_argument("--consensus-cache-size",
+                        help="The maximum size (in Gb) of the consensus cache, least recently used consensuses are removed",
+                        required=False,
+                        type=float,
+                        default=10)
+    parser.add_argument("--scratch-dir",
+                        help="Directory for the temporary files of the Flye polisher, preferably on a local disk (default: <output>/intermediate/flye_scratch)",
+                        required=False,
+                        default=None)
+    parser.add_argument("--scratch-size",
+                        help="The maximum size (in Gb) of the temporary files of the Flye polisher, polishing waits when it is reached",
+                        required=False,
+                        type=float,
+                        default=20)
     parser.add_argument("-v", "--version", action="version", version=_version())
 
     args = parser.parse_args()
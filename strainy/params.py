@@ -1,4 +1,5 @@
 import os
+import hashlib
 
 
 #TODO: this is a temporary way to share some global "constants"
@@ -37,6 +38,15 @@ def init_global_args_storage(args):
     _glob_args.min_unitig_coverage = args.min_unitig_coverage
     _glob_args.max_unitig_coverage = args.max_unitig_coverage
     _glob_args.edges_to_phase = args.edges_to_phase
+    _glob_args.consensus_cache = args.consensus_cache or os.path.join(args.output, "consensus_cache")
+    _glob_args.consensus_cache_size = args.consensus_cache_size
+    #runs sharing a scratch directory use separate subdirectories
+    if args.scratch_dir:
+        run_tag = hashlib.sha1(os.path.abspath(args.output).encode()).hexdigest()[:12]
+        _glob_args.scratch_dir = os.path.join(args.scratch_dir, f"strainy_{run_tag}")
+    else:
+        _glob_args.scratch_dir = os.path.join(_glob_args.output_intermediate, "flye_scratch")
+    _glob_args.scratch_size = args.scratch_size
 
 
 def StRainyArgs():
@@ -47,14 +57,24 @@ def StRainyArgs():
 
 #TODO: constant storage
 
-# Path to store and read the consensus dictionary
-# If one already exists and write_consensus_cache is true, it may be overwritten
+# Directory of the consensus log, which is written by phase and read by transform
+# If one already exists and write_consensus_cache is true, it is overwritten: its records are keyed by
+# the cluster numbering of the run that wrote them, so a rerun of phase (e.g. after a crash) can not reuse them.
+# Only the persistent consensus cache (--consensus-cache, keyed by the read alignments) survives a crash
+consensus_log_path = "consensus_log"
+# Consensus dictionary of the earlier versions, read by transform if there is no consensus log
 consensus_cache_path = "consensus_dict.pkl"
 
 # Whether to store the consensus cache or not
 # This needs to be True to carry out it from phase part to transform part
 write_consensus_cache = True
 delete_flye_files = True
+# Number of clusters polished as separate contigs in a single Flye polisher run
+max_polish_batch = 50
+# Estimated scratch space taken by a polisher run per base of its reads
+scratch_bytes_per_base = 4
+# Size (in bytes) of the consensus and alignment cache kept by every worker in front of the shared one
+local_cache_size = 256 * 1024 ** 2
 
 """It is not recommended to change parameters below"""
 
@@ -66,6 +86,13 @@ min_cluster_size = 2
 UNCLUSTERED_GROUP_N = 1000000
 UNCLUSTERED_GROUP_N2 = 3000000
 SPLIT_ID = 10000
+max_split_operations = 2000 # split_cluster calls allowed per unitig in split_all
+parallel_min_reads = 1000 # distance matrices of fewer reads are never shared with idle workers
+# allele profile prescreen of the cluster pairs compared by consensus alignment:
+# bound on the fraction of discordant alleles at common SNPs (Wilson interval with z = profile_confidence_z)
+profile_prescreen = True
+profile_confidence_z = 1.96
+profile_distinct_bound = 0.3 # lower bound above which the clusters are distinct
 
 #creating new unitigs
 parental_min_coverage = 6
@@ -90,6 +117,10 @@ min_al_len = 1000
 # extended_aln_flank = 50
 de_max = {"hifi": 0.05, "nano": 0.10}
 min_consensus_cov = {"hifi": 3, "nano": 5}
+# Expected divergence between cluster consensuses, sets the initial edlib band
+consensus_divergence = {"hifi": 0.005, "nano": 0.02}
+# Cluster consensus backend: "flye" (polisher) or "pileup" (majority vote, intended for hifi reads)
+consensus_backend = {"hifi": "flye", "nano": "flye"}
 
 # SNP allele frequency
 split_allele_freq = 0.3
@@ -1,9 +1,7 @@
 import multiprocessing
 import pysam
-import pickle
 import os
 import sys
-import subprocess
 import multiprocessing
 import logging
 import shutil
@@ -11,19 +9,29 @@ import traceback
 import time
 
 from strainy.clustering.cluster import cluster
-from strainy.color_bam import color
+from strainy.color_bam import write_phased_bam
 from strainy.flye_consensus import FlyeConsensus
+from strainy.consensus_store import ConsensusLog
 from strainy.params import *
 from strainy.logging import set_thread_logging
+from strainy.reference_store import get_reference_store
+from strainy.work_queue import WorkQueue, set_work_queue
 
 
 logger = logging.getLogger()
 
 
-def _thread_fun(i, shared_flye_consensus, args):
+def _thread_fun(i, shared_flye_consensus, work_queue, args):
     init_global_args_storage(args)
 
     set_thread_logging(StRainyArgs().log_phase, "phase", multiprocessing.current_process().pid)
+    if i is None:
+        #no unitigs left, help the workers that are still running
+        work_queue.help()
+        shared_flye_consensus.flush_statistics()
+        return
+
+    set_work_queue(work_queue)
     logger.info("\n\n\t == == Processing unitig " + str(StRainyArgs().edges_to_phase[i]) + " == == ")
 
     try:
@@ -31,6 +39,9 @@ def _thread_fun(i, shared_flye_consensus, args):
     except Exception as e:
         logger.error("Worker thread exception! " + str(e) + "\n" + traceback.format_exc())
         raise e
+    finally:
+        shared_flye_consensus.flush_statistics()
+        work_queue.unitig_finished()
 
     logger.debug("Thread worker function finished!")
 
@@ -40,13 +51,25 @@ def phase(edges, args):
 
     empty_consensus_dict = {}
     default_manager = multiprocessing.Manager()
-    shared_flye_consensus = FlyeConsensus(StRainyArgs().bam, StRainyArgs().fa, 1, empty_consensus_dict, default_manager)
+    consensus_log = None
+    if write_consensus_cache:
+        #consensuses are streamed to the log as they are computed. The records of an earlier run are
+        #keyed by its cluster numbering and are removed, the persistent cache keeps them by content
+        consensus_log = ConsensusLog(os.path.join(StRainyArgs().output_intermediate, consensus_log_path))
+        consensus_log.clear()
+    shared_flye_consensus = FlyeConsensus(StRainyArgs().bam, StRainyArgs().fa, 1, empty_consensus_dict, default_manager,
+                                          consensus_log=consensus_log)
     if StRainyArgs().threads == 1:
         for i in range(len(edges)):
             cluster(i, shared_flye_consensus)
     else:
         pool = multiprocessing.Pool(StRainyArgs().threads)
-        init_args = [(i, shared_flye_consensus, args) for i in range(len(edges))]
+        work_queue = WorkQueue(default_manager, len(edges))
+        #the largest unitigs go first, the workers that run out of unitigs help with them
+        reference = get_reference_store(StRainyArgs().fa)
+        order = sorted(range(len(edges)), key=lambda i: reference.length(edges[i]), reverse=True)
+        init_args = [(i, shared_flye_consensus, work_queue, args) for i in order]
+        init_args += [(None, shared_flye_consensus, work_queue, args)] * StRainyArgs().threads
 
         results = pool.starmap_async(_thread_fun, init_args, chunksize=1)
         while not results.ready():
@@ -59,41 +82,14 @@ def phase(edges, args):
         pool.join()
 
     shared_flye_consensus.print_cache_statistics()
-    return shared_flye_consensus.get_consensus_dict()
+    shared_flye_consensus.evict_persistent_cache()
+    shared_flye_consensus.cleanup_scratch()
 
 
 def color_bam(edges):
     logger.info("Creating phased bam")
-    for e in edges:
-        color(e)
-
-    out_bam_dir = os.path.join(StRainyArgs().output_intermediate, "bam")
     final_aln = os.path.join(StRainyArgs().output, "alignment_phased.bam")
-
-    files_to_be_merged = []
-    for fname in subprocess.check_output(f'find {out_bam_dir} -name "*unitig*.bam"', shell = True, universal_newlines = True).split("\n"):
-        if len(fname):
-            files_to_be_merged.append(fname)
-
-    # Number of file to be merged could be > 4092, in which case samtools merge throws too many open files error
-    for i, bam_file in enumerate(files_to_be_merged):
-        # fetch the header and put it at the top of the file, for the first bam_file only
-        if i == 0:
-            subprocess.check_output(f'samtools view -H {bam_file} > {out_bam_dir}/coloredSAM.sam', shell = True)
-
-        # convert bam to sam, append to the file
-        subprocess.check_output(f'samtools view {bam_file} >> {out_bam_dir}/coloredSAM.sam', shell = True)
-
-    # convert the file to bam and sort
-    subprocess.check_output(f'samtools view -b {out_bam_dir}/coloredSAM.sam >> {out_bam_dir}/unsortedBAM.bam', shell = True)
-    pysam.samtools.sort(f'{out_bam_dir}/unsortedBAM.bam', "-o", final_aln)
-    pysam.samtools.index(final_aln)
-
-    # remove unnecessary files
-    os.remove(f'{out_bam_dir}/unsortedBAM.bam')
-    os.remove(f'{out_bam_dir}/coloredSAM.sam')
-    for f in files_to_be_merged:
-        os.remove(f)
+    write_phased_bam(edges, final_aln, StRainyArgs().threads)
 
 
 def phase_main(args):
@@ -102,9 +98,7 @@ def phase_main(args):
     dirs = ("%s/vcf/" % StRainyArgs().output_intermediate,
             "%s/clusters/" % StRainyArgs().output_intermediate,
             "%s/bam/" % StRainyArgs().output_intermediate,
-            "%s/bam/clusters" % StRainyArgs().output_intermediate,
-            "%s/flye_inputs" % StRainyArgs().output_intermediate,
-            "%s/flye_outputs" % StRainyArgs().output_intermediate
+            "%s/bam/clusters" % StRainyArgs().output_intermediate
     )
     
     debug_dirs = ("%s/graphs/" % StRainyArgs().output_intermediate,
@@ -117,10 +111,7 @@ def phase_main(args):
     if StRainyArgs().debug:
         os.makedirs(dir, exist_ok=True)
 
-    consensus_dict = phase(StRainyArgs().edges_to_phase, args)
-    if write_consensus_cache:
-        with open(os.path.join(StRainyArgs().output_intermediate, consensus_cache_path), "wb") as f:
-            pickle.dump(consensus_dict, f)
+    phase(StRainyArgs().edges_to_phase, args)
     color_bam(StRainyArgs().edges)
     logger.info("Done")
 
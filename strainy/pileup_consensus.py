@@ -0,0 +1,82 @@
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+#pileup columns: A, C, G, T, deletion, N
+_DELETION = 4
+_OTHER = 5
+_CODES = np.full(256, _OTHER, dtype=np.int8)
+for _i, _base in enumerate(b"ACGT"):
+    _CODES[_base] = _i
+    _CODES[ord(chr(_base).lower())] = _i
+_LETTERS = np.frombuffer(b"ACGT-", dtype=np.uint8)
+
+
+def pileup_consensus(reference_slice, reads, region_start):
+    """
+    Majority-vote consensus of the reads aligned to reference_slice, which starts at region_start
+    on the edge. Every reference position gets the most frequent base (or is deleted),
+    insertions supported by more than half of the reads covering the position are added,
+    and positions without coverage keep the reference base.
+    reads: pysam alignments to the edge, within the slice
+    Returns the consensus sequence and its coverage as (start, end, coverage) rows
+    in consensus coordinates, like base_coverage.bed of the Flye polisher
+    """
+    length = len(reference_slice)
+    counts = np.zeros((length, 6), dtype=np.int32)
+    insertions = defaultdict(Counter)
+
+    for read in reads:
+        if read.query_sequence is None or read.cigartuples is None:
+            continue
+        query = np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)
+        ref_pos = read.reference_start - region_start
+        query_pos = 0
+        for op, op_len in read.cigartuples:
+            if op in (0, 7, 8):     #M, =, X
+                counts[np.arange(ref_pos, ref_pos + op_len), _CODES[query[query_pos:query_pos + op_len]]] += 1
+                ref_pos += op_len
+                query_pos += op_len
+            elif op == 1:           #I, placed after the previous reference base
+                if 0 < ref_pos <= length:
+                    insertions[ref_pos - 1][read.query_sequence[query_pos:query_pos + op_len]] += 1
+                query_pos += op_len
+            elif op in (2, 3):      #D, N
+                counts[ref_pos:ref_pos + op_len, _DELETION] += 1
+                ref_pos += op_len
+            elif op == 4:           #S
+                query_pos += op_len
+
+    depth = counts[:, :_OTHER].sum(axis=1)
+    bases = _LETTERS[counts[:, :_OTHER].argmax(axis=1)]
+    bases = np.where(depth == 0, np.frombuffer(reference_slice.upper().encode(), dtype=np.uint8), bases)
+
+    sequence = []
+    coverage = []
+    prev = 0
+    for pos in sorted(insertions):
+        inserted, support = insertions[pos].most_common(1)[0]
+        if 2 * support <= depth[pos]:
+            continue
+        sequence.append(bases[prev:pos + 1])
+        coverage.append(depth[prev:pos + 1])
+        sequence.append(np.frombuffer(inserted.upper().encode(), dtype=np.uint8))
+        coverage.append(np.full(len(inserted), support, dtype=depth.dtype))
+        prev = pos + 1
+    sequence.append(bases[prev:])
+    coverage.append(depth[prev:])
+
+    sequence = np.concatenate(sequence)
+    coverage = np.concatenate(coverage)
+    kept = sequence != ord("-")
+    sequence = sequence[kept]
+    coverage = coverage[kept]
+
+    rows = []
+    if len(coverage):
+        breaks = np.flatnonzero(np.diff(coverage)) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(coverage)]))
+        rows = [[int(s), int(e), int(coverage[s])] for s, e in zip(starts, ends)]
+    return sequence.tobytes().decode(), rows
@@ -5,6 +5,7 @@ import pysam
 import gfapy
 
 from strainy.params import StRainyArgs
+from strainy.reference_store import build_fasta_index
 
 logger = logging.getLogger()
 
@@ -202,6 +203,7 @@ def preprocess_cmd_args(args):
         gfa_to_fasta(args.gfa,
                      os.path.join(preprocessing_dir,"gfa_converted.fasta"))
         args.fasta = os.path.join(preprocessing_dir,"gfa_converted.fasta")
+    build_fasta_index(args.fasta)
 
     if args.bam is None or args.unitig_split_length != 0:
         create_bam_file(args.fasta,
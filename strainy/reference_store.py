@@ -0,0 +1,96 @@
+import os
+import mmap
+import logging
+
+import pysam
+
+
+logger = logging.getLogger()
+
+
+class ReferenceStore:
+    """
+    Random access to the unitig sequences of a fasta file through its .fai index.
+    The fasta is memory-mapped, so a sequence (or its subrange) is read
+    directly from the page cache and no process holds the whole assembly.
+    Only the path and the index are pickled, the mapping is re-opened lazily
+    in every process.
+    """
+    def __init__(self, fasta_path):
+        self._fasta_path = fasta_path
+        self._index = _read_fai(build_fasta_index(fasta_path))
+        self._file = None
+        self._mmap = None
+
+    def __getstate__(self):
+        return {"_fasta_path": self._fasta_path, "_index": self._index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._file = None
+        self._mmap = None
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def names(self):
+        return list(self._index.keys())
+
+    def length(self, name):
+        return self._index[name][0]
+
+    def fetch(self, name, start=0, end=None):
+        """
+        Returns the sequence of the unitig name in the [start, end) interval
+        """
+        if name not in self._index:
+            raise Exception("Reference sequence not found")
+        length, offset, line_bases, line_width = self._index[name]
+        start = max(0, min(start, length))
+        end = length if end is None else max(start, min(end, length))
+        if start == end:
+            return ""
+
+        if self._mmap is None:
+            self._file = open(self._fasta_path, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+        chunk = self._mmap[first:last]
+        if line_width != line_bases:
+            chunk = chunk.replace(b"\n", b"").replace(b"\r", b"")
+        return chunk.decode("ascii")
+
+
+def build_fasta_index(fasta_path):
+    """
+    Creates the .fai index for the fasta file, unless an up-to-date one exists
+    """
+    fai_path = fasta_path + ".fai"
+    if not os.path.isfile(fai_path) or os.path.getmtime(fai_path) < os.path.getmtime(fasta_path):
+        logger.debug(f"Indexing {fasta_path}")
+        pysam.faidx(fasta_path)
+    return fai_path
+
+
+def _read_fai(fai_path):
+    index = {}
+    with open(fai_path) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            index[fields[0]] = tuple(int(x) for x in fields[1:5])
+    return index
+
+
+_stores = {}
+
+def get_reference_store(fasta_path):
+    """
+    Per-process cache of the reference stores
+    """
+    if fasta_path not in _stores:
+        _stores[fasta_path] = ReferenceStore(fasta_path)
+    return _stores[fasta_path]
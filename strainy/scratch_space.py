@@ -0,0 +1,69 @@
+import os
+import time
+import shutil
+import logging
+import itertools
+from contextlib import contextmanager
+
+
+logger = logging.getLogger()
+
+#the object is copied to the workers with every task, so the job numbers are kept per process
+_job_counter = itertools.count(1)
+
+
+class ScratchSpace:
+    """
+    Directory for the temporary files of the polisher runs, which can be on a node-local disk.
+    Every worker process gets its own subdirectory (created once and reused by all of its runs),
+    and the files of a run are named by a per-worker counter.
+    The space reserved by the running polishers is shared between the workers and bounded by max_bytes:
+    a run that does not fit waits until others finish (a single run is always allowed)
+    """
+    def __init__(self, path, max_bytes, multiproc_manager):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._lock = multiproc_manager.Lock()
+        self._used = multiproc_manager.Value("q", 0)
+
+    def _dir(self):
+        worker_dir = os.path.join(self._path, f"worker_{os.getpid()}")
+        os.makedirs(worker_dir, exist_ok=True)
+        return worker_dir
+
+    def new_prefix(self):
+        """
+        Returns a path prefix in the worker subdirectory that was not given out by this worker before
+        """
+        return os.path.join(self._dir(), f"job{next(_job_counter)}")
+
+    @contextmanager
+    def reserve(self, n_bytes):
+        """
+        Holds n_bytes of the scratch space while the block runs
+        """
+        waited = False
+        while True:
+            with self._lock:
+                if self._used.value == 0 or self._used.value + n_bytes <= self._max_bytes:
+                    self._used.value += n_bytes
+                    break
+            if not waited:
+                logger.debug(f"Waiting for {n_bytes} bytes of scratch space in {self._path}")
+                waited = True
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._used.value -= n_bytes
+
+    def cleanup(self):
+        """
+        Removes the subdirectories of all workers
+        """
+        if not os.path.isdir(self._path):
+            return
+        for name in os.listdir(self._path):
+            if name.startswith("worker_"):
+                shutil.rmtree(os.path.join(self._path, name), ignore_errors=True)
@@ -2,7 +2,7 @@ import networkx as nx
 import pygraphviz as gv
 import re
 import gfapy
-from collections import Counter, deque, defaultdict
+from collections import Counter, deque, defaultdict, namedtuple
 import pandas as pd
 import pickle
 import logging
@@ -18,7 +18,10 @@ import strainy.clustering.cluster_postprocess as postprocess
 import strainy.simplification.simplify_links as smpl
 import strainy.gfa_operations.gfa_ops as gfa_ops
 from strainy.flye_consensus import FlyeConsensus
+from strainy.consensus_store import ConsensusLog
+from strainy.gfa_operations.segment_store import Segment, get_segment_store
 import strainy.clustering.build_data as build_data
+from strainy.clustering.cluster_assignment import ClusterAssignment
 from strainy.params import *
 from strainy.logging import set_thread_logging
 from strainy.reports.strainy_stats import strain_stats_report
@@ -79,7 +82,10 @@ def write_reference_unitig_csv():
         write.writerows(list(StRainyArgs().reference_unitig_info_table.values()))
 
 
-def store_phased_unitig_info(strain_unitig, reference_unitig, n_SNPs, start, end):
+def phased_unitig_info(strain_unitig, reference_unitig, n_SNPs, start, end):
+    """
+    Returns the row of the phased unitig info table of the strain unitig
+    """
     reference_coverage = round(float(pysam.samtools.coverage("-r",
                                                              reference_unitig,
                                                              StRainyArgs().bam,
@@ -101,7 +107,7 @@ def store_phased_unitig_info(strain_unitig, reference_unitig, n_SNPs, start, end
     except ZeroDivisionError:
         abundance_ratio = 0
 
-    StRainyArgs().phased_unitig_info_table[strain_unitig.name] = [
+    return [
         strain_unitig.name,
         reference_unitig,
         strain_unitig.length,
@@ -141,46 +147,53 @@ def store_reference_unitig_info(ref_coverage):
         ]
 
 
-def add_child_edge(edge, clN, g, cl, left, right, cons, flye_consensus, change_seq=True, insertmain=True):
+UnitigRecord = namedtuple("UnitigRecord", ["name", "edge", "sequence", "dp", "info"])
+
+
+def child_unitig(edge, clN, left, right, cons, consensus, segments, insertmain=True):
     """
-    The function creates unitigs in the gfa graph
+    Creates the record of the unitig of the cluster, ready to be inserted in the gfa graph.
+    consensus is None if the sequence of the unitig is the sequence of the edge
+    (the record then refers to it instead of holding a copy)
     """
-    ##TODO make separare function to add gfa edge and move to gfa_ops
-    consensus = flye_consensus.flye_consensus(clN, edge, cl)
-    consensus_start = consensus["start"]
-    cons_length_diff = len(consensus["consensus"]) - (consensus["end"] - consensus["start"])
-    logger.debug(f'Consensus length difference: {cons_length_diff}')
-    if consensus_start > left and insertmain==True:
-        main_seq = g.try_get_segment(edge)
-        insert = main_seq.sequence[left:consensus_start]
-        seq = str(consensus["consensus"])[0 : right - consensus_start + cons_length_diff + 1]
-        seq = insert+seq
-    else:
-        seq = str(consensus["consensus"])[left - consensus_start : right - consensus_start + cons_length_diff + 1]
-
-    g.add_line("S\t%s_%s\t*" % (edge, clN))
-    new_line = g.try_get_segment("%s_%s" % (edge, clN))
-    new_line.name = str(edge) + "_" + str(clN)
-    new_line.sid = str(edge) + "_" + str(clN)
-    new_line.dp = round(cons[clN]["Cov"])  # TODO: what to do with coverage?
-    #remove_zeroes.append("S\t%s_%s\t*" % (edge, clN))
-    if change_seq==True:
-        if len(seq) == 0:
-            new_line.sequence = "A"
+    main_seq = segments.try_get_segment(edge)
+    seq = None
+    if consensus is not None:
+        consensus_start = consensus["start"]
+        cons_length_diff = len(consensus["consensus"]) - (consensus["end"] - consensus["start"])
+        logger.debug(f'Consensus length difference: {cons_length_diff}')
+        if consensus_start > left and insertmain==True:
+            insert = main_seq.sequence[left:consensus_start]
+            seq = str(consensus["consensus"])[0 : right - consensus_start + cons_length_diff + 1]
+            seq = insert+seq
         else:
-            new_line.sequence = seq
-    else:
-        new_line.sequence = g.try_get_segment("%s" % edge).sequence
-
-    logger.debug("Unitig created  %s_%s" % (edge, clN))
+            seq = str(consensus["consensus"])[left - consensus_start : right - consensus_start + cons_length_diff + 1]
+        if len(seq) == 0:
+            seq = "A"
 
-    store_phased_unitig_info(new_line,
+    name = "%s_%s" % (edge, clN)
+    dp = round(cons[clN]["Cov"])  # TODO: what to do with coverage?
+    new_line = Segment(name, main_seq.sequence if seq is None else seq, {"dp": dp})
+    info = phased_unitig_info(new_line,
                     edge,
                     len(cons[clN]) - 7,
                     left,
                     right
                     )
-    
+    return UnitigRecord(name, edge, seq, dp, info)
+
+
+def add_child_edge(g, record):
+    """
+    The function creates unitigs in the gfa graph
+    """
+    ##TODO make separare function to add gfa edge and move to gfa_ops
+    seq = record.sequence if record.sequence is not None else g.try_get_segment(record.edge).sequence
+    g.add_line("S\t%s\t%s" % (record.name, seq))
+    g.try_get_segment(record.name).dp = record.dp
+    StRainyArgs().phased_unitig_info_table[record.name] = record.info
+    logger.debug("Unitig created  %s" % record.name)
+
 
 def build_paths_graph(cons, full_paths_roots, full_paths_leafs, cluster_distances):
     """
@@ -270,11 +283,6 @@ def paths_graph_add_vis(edge, cons, cl, full_paths_roots,
     except:
         pass
 
-    cluster_colors = {}
-    for i, row in cl.iterrows():
-        if row["Cluster"] not in cluster_colors:
-            cluster_colors[row["Cluster"]] = row["Color"]
-
     for e in G_vis.edges():
         first_cl, second_cl = e
         intersect = min(cons[first_cl]["End"], cons[second_cl]["End"]) - \
@@ -283,8 +291,7 @@ def paths_graph_add_vis(edge, cons, cl, full_paths_roots,
 
     for n in G_vis.nodes():
         clust_len = cons[n]["End"] - cons[n]["Start"]
-        color = cluster_colors[n]
-        G_vis.nodes[n]["label"] = f"{color} len:{clust_len}"
+        G_vis.nodes[n]["label"] = f"{n} len:{clust_len}"
 
     G_vis.add_node("Src",style = "filled",fillcolor = "gray",shape = "square")
     G_vis.add_node("Sink",style = "filled",fillcolor = "gray",shape = "square")
@@ -304,37 +311,51 @@ def paths_graph_add_vis(edge, cons, cl, full_paths_roots,
     graph_vis.draw("%s/graphs/connection_graph_%s.png" % (StRainyArgs().output_intermediate, edge))
 
 
+def reachable_nodes(G, sources, reverse=False):
+    """
+    Nodes reachable from any of the sources (or reaching them, if reverse), sources included
+    """
+    neighbors = G.predecessors if reverse else G.successors
+    visited = set(sources)
+    queue = deque(sources)
+    while queue:
+        node = queue.popleft()
+        for n in neighbors(node):
+            if n not in visited:
+                visited.add(n)
+                queue.append(n)
+    return visited
+
+
 def find_full_paths(G, paths_roots, paths_leafs):
-    paths = []
-    for root in paths_roots:
-        try:
-            #TODO: we need to increas cutoff for longer unitigs with more clusters.
-            #But this will result in the exponential number of paths. Instead, we should be
-            #looking at all nodes that are reachable from both source and sink, which is linear
-            paths_nx = nx.algorithms.all_simple_paths(G, root, paths_leafs, cutoff = 10)
-        except:
-            pass
-        for path in list(paths_nx):
-            paths.append(path)
+    """
+    Returns the DAG formed by all paths from roots to leafs in G:
+    the edges which start is reachable from a root and which end reaches a leaf.
+    This is linear in the size of G, instead of enumerating the (exponential number of) paths
+    """
+    roots = [n for n in paths_roots if n in G]
+    leafs = [n for n in paths_leafs if n in G]
+    from_roots = reachable_nodes(G, roots)
+    to_leafs = reachable_nodes(G, leafs, reverse=True)
 
-    return (paths)
+    paths = nx.DiGraph()
+    paths.add_edges_from((u, v) for u, v in G.edges() if u in from_roots and v in to_leafs)
+    return paths
 
 
-def add_path_links(graph, edge, paths, G):
+def path_links(edge, paths):
     """
-     Add gfa links between newly created unitigs forming "full path"
+     Gfa links between newly created unitigs forming "full path"
     """
-    for path in paths:
-        for i in range(0, len(path) - 1):
-            gfa_ops.add_link(graph, f"{edge}_{path[i]}", "+", f"{edge}_{path[i + 1]}", "+", 1)
+    return [(f"{edge}_{u}", f"{edge}_{v}") for u, v in paths.edges()]
 
 
-def add_path_edges(edge, g, cl, ln, full_paths, G, paths_roots, paths_leafs, full_clusters, cons, flye_consensus):
+def path_cluster_cuts(ln, full_paths, G, paths_roots, paths_leafs, full_clusters, cons):
     """
-    Add gfa nodes (unitigs) forming "full path", calculating cluster boundaries
+    Calculates the boundaries of the "full path" clusters, updating full_paths and G in place:
+    paths through full clusters or through a leaf are dropped, and the clusters that get no sequence
+    are bypassed. Returns (cluster, left, right) for every path cluster that gets a unitig
     """
-    path_cl = []
-    logger.debug("Add path")
     for node in full_clusters:
         try:
             paths_roots.remove(node)
@@ -342,25 +363,18 @@ def add_path_edges(edge, g, cl, ln, full_paths, G, paths_roots, paths_leafs, ful
         except:
             pass
 
-    for path in full_paths.copy():
-        for member in path:
-            if member in full_clusters:
-                try:
-                    full_paths.remove(path)
-                except (ValueError):
-                    pass
-            if member in paths_leafs and path.index(member)!= len(path)-1:
-                try:
-                    full_paths.remove(path)
-                except (ValueError):
-                    pass
-
-    for path in full_paths:
-        for member in path:
-            path_cl.append(member)
+    #paths may only end in a leaf and should not contain full clusters
+    allowed = full_paths.copy()
+    allowed.remove_nodes_from([n for n in full_clusters if n in allowed])
+    allowed.remove_edges_from([(u, v) for u, v in allowed.edges() if u in paths_leafs])
+    kept = find_full_paths(allowed, paths_roots, paths_leafs)
+    full_paths.remove_edges_from([(u, v) for u, v in full_paths.edges() if not kept.has_edge(u, v)])
+    full_paths.remove_nodes_from([n for n in full_paths.nodes() if n not in kept])
+
+    path_cl = list(full_paths.nodes())
     cut_l_unsorted = {}
     cut_r_unsorted = {}
-    for path_cluster in set(path_cl):
+    for path_cluster in path_cl:
         cut_l_unsorted[path_cluster] = None
         cut_r_unsorted[path_cluster] = None
         if path_cluster in paths_roots and cons[path_cluster]["Start"] < start_end_gap :
@@ -385,40 +399,26 @@ def add_path_edges(edge, g, cl, ln, full_paths, G, paths_roots, paths_leafs, ful
                 member=Members.pop(0)
                 Members.insert(0,member_to_q)
         if cut_l[member] != None and (cut_r[member] == None or member in paths_leafs):
-            Q = deque()
-            L = []
+            #L: clusters starting at the border, R: clusters ending at it
+            L = list(full_paths.successors(member))
             R = []
-            for path in full_paths:
-                try:
-                    L.append(path[path.index(member) + 1])
-                    Q.append(path[path.index(member) + 1])
-                except (ValueError, IndexError):
-                    continue
-            visited = []
-            Q = list(set(Q))
+            Q = list(set(L))
+            visited = set()
             while Q:
                 n = Q.pop()
-                visited.append(n)
+                visited.add(n)
                 if n in L:
-                    for path in full_paths:
-                        try:
-                            if path.index(n) > 0:
-                                if path[path.index(n) - 1] not in visited:
-                                    R.append(path[path.index(n) - 1])
-                                    if path[path.index(n) - 1] not in Q:
-                                        Q.append(path[path.index(n) - 1])
-                        except (ValueError, IndexError):
-                            continue
+                    for prev in full_paths.predecessors(n):
+                        if prev not in visited:
+                            R.append(prev)
+                            if prev not in Q:
+                                Q.append(prev)
                 else:
-                    for path in full_paths:
-                        try:
-                            if path[path.index(n) + 1] not in visited:
-                                L.append(path[path.index(n) + 1])
-                                if path[path.index(n) + 1] not in Q:
-                                    Q.append(path[path.index(n) + 1])
-
-                        except (ValueError, IndexError):
-                                continue
+                    for succ in full_paths.successors(n):
+                        if succ not in visited:
+                            L.append(succ)
+                            if succ not in Q:
+                                Q.append(succ)
             l_borders = []
             r_borders = []
             for i in L:
@@ -435,32 +435,25 @@ def add_path_edges(edge, g, cl, ln, full_paths, G, paths_roots, paths_leafs, ful
             for i in R:
                 cut_r[i] = border
         elif cut_r[member] != None:
-            for path in full_paths:
-                try:
-                    cut_l[path[path.index(member)+1]] = cut_r[member]
-                except:
-                    pass
+            for succ in full_paths.successors(member):
+                cut_l[succ] = cut_r[member]
 
     if None in cut_l.values():
         for member in cut_l.keys():
             if cut_l[member] == None:
-                for path in full_paths:
-                    try:
-                        cut_l[member] = cut_r[path[path.index(member)-1]]
-                    except:
-                        pass
-    for path_cluster in set(path_cl):
+                for prev in full_paths.predecessors(member):
+                    cut_l[member] = cut_r[prev]
+    cuts = []
+    for path_cluster in path_cl:
         if cut_l[path_cluster]!= cut_r[path_cluster]:
-            add_child_edge(edge, path_cluster, g,  cl, cut_l[path_cluster], cut_r[path_cluster], cons, flye_consensus)
+            cuts.append((path_cluster, cut_l[path_cluster], cut_r[path_cluster]))
         else:
-            for i in range(0,len(full_paths)):
-                if path_cluster in full_paths[i]:
-                    upd_path = full_paths[i]
-                    upd_path.remove(path_cluster)
-                    full_paths[i] = upd_path
+            #bypass the cluster, linking its neighbours along the paths directly
+            full_paths.add_edges_from([(prev, succ) for prev in full_paths.predecessors(path_cluster)
+                                       for succ in full_paths.successors(path_cluster)])
+            full_paths.remove_node(path_cluster)
             G.remove_node(path_cluster)
-
-    return(path_cl)
+    return cuts
 
 
 def change_cov(g, edge, cons, ln, clusters, othercl, remove_clusters):
@@ -478,31 +471,11 @@ def change_cov(g, edge, cons, ln, clusters, othercl, remove_clusters):
     return cov
 
 
-def change_sec(g, edge, othercl, cl,SNP_pos, data, cut = True):
-    temp = {}
-    other_cl = cl
-    for cluster in othercl:
-        other_cl.loc[cl["Cluster"] == cluster, "Cluster"] = "OTHER_%s" %edge
-
-    reference_seq = build_data.read_fasta_seq(StRainyArgs().fa, edge)
-    cl_consensuns = build_data.cluster_consensuns(other_cl, "OTHER_%s" %edge, SNP_pos, data, temp, edge, reference_seq)
-    i = g.try_get_segment(edge)
-    seq = i.sequence
-    seq = list(seq)
-    for key, val in cl_consensuns["OTHER_%s" %edge].items():
-        try:
-            seq[int(key) - 1] = val
-        except (ValueError):
-            continue
-    i.sequence=''.join(seq)
-
-
-
 def strong_tail(cluster, cl, ln, data):
     count_start = None
     count_stop = None
     res = [False,False]
-    reads = list(cl.loc[cl["Cluster"] == cluster, "ReadName"])
+    reads = cl.reads(cluster)
     for read in reads:
         if data[read]["Start"] < start_end_gap:
             if count_start == None:
@@ -522,11 +495,12 @@ def strong_tail(cluster, cl, ln, data):
 def gcu_worker(edge, flye_consensus, args):
     init_global_args_storage(args)
 
-    bam_cache = {}
+    read_clips = {}
     link_clusters = defaultdict(list)
     link_clusters_src = defaultdict(list)
     link_clusters_sink = defaultdict(list)
-    graph_ops = []
+    unitigs = []
+    links = []
     remove_clusters = set()
 
     set_thread_logging(StRainyArgs().log_transform, "gcu", multiprocessing.current_process().pid)
@@ -535,16 +509,19 @@ def gcu_worker(edge, flye_consensus, args):
     try:
         graph_create_unitigs(edge,
                             flye_consensus,
-                            bam_cache,
+                            read_clips,
                             link_clusters,
                             link_clusters_src,
                             link_clusters_sink,
                             remove_clusters,
-                            graph_ops)
+                            unitigs,
+                            links)
     except Exception as e:
         logger.error("Worker thread exception! " + str(e) + "\n" + traceback.format_exc())
         raise e
-    return bam_cache, link_clusters, link_clusters_src, link_clusters_sink, graph_ops, remove_clusters
+    finally:
+        flye_consensus.flush_statistics()
+    return read_clips, link_clusters, link_clusters_src, link_clusters_sink, unitigs, links, remove_clusters
 
 
 def parallelize_gcu(pool, graph_edges, flye_consensus, graph, args):
@@ -565,52 +542,53 @@ def parallelize_gcu(pool, graph_edges, flye_consensus, graph, args):
         pool.close()
         pool.join()
 
-    bam_cache = {}
+    read_clips = {}
     link_clusters = defaultdict(list)
     link_clusters_src = defaultdict(list)
     link_clusters_sink = defaultdict(list)
-    graph_ops = []
-    remove_clusters = []
-    
-    outputs = [bam_cache, link_clusters, link_clusters_src, link_clusters_sink, graph_ops, remove_clusters]
-    # join the results of multiple threads
-    for r in result_values:
-        for i in range(len(r)):
-            if i == len(r) - 1 or i == len(r) - 2:
-                for k in r[i]:
-                    outputs[i].append(k)
-            else:
-                for k, v in r[i].items():
-                    outputs[i][k] = v
-    
-    # operations on the graph performed after the parallel graph_create_unitig
-    # this is due to not being able to pass the graph object to threads
-    for op in graph_ops:
-        if op[0] == 'add_child_edge':
-            add_child_edge(op[1], op[2], graph, op[3], op[4], op[5], op[6], flye_consensus, op[7], op[8])
-        elif op[0] == 'add_path_edges':
-            add_path_edges(op[1], graph, op[2], op[5], op[6], op[7], op[8], op[9], op[10], op[11], flye_consensus)
-        elif op[0] == 'add_path_links':
-            add_path_links(graph, op[1], op[2], op[3])
-        
-    return bam_cache, link_clusters, link_clusters_src, link_clusters_sink, set(remove_clusters), graph
-
+    unitigs = []
+    links = []
+    remove_clusters = set()
 
-def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
-                         link_clusters_src, link_clusters_sink, remove_clusters, graph_ops):
+    # join the results of multiple threads
+    for r_clips, r_link, r_src, r_sink, r_unitigs, r_links, r_remove in result_values:
+        read_clips.update(r_clips)
+        link_clusters.update(r_link)
+        link_clusters_src.update(r_src)
+        link_clusters_sink.update(r_sink)
+        unitigs += r_unitigs
+        links += r_links
+        remove_clusters.update(r_remove)
+
+    # the workers return the finished unitigs and links, which are added to the graph here
+    # as the graph object can not be passed to threads
+    logger.info(f"Adding {len(unitigs)} unitigs and {len(links)} links to the graph")
+    for record in unitigs:
+        add_child_edge(graph, record)
+    for fr, to in links:
+        gfa_ops.add_link(graph, fr, "+", to, "+", 1)
+
+    return read_clips, link_clusters, link_clusters_src, link_clusters_sink, remove_clusters, graph
+
+
+def graph_create_unitigs(edge, flye_consensus, read_clips, link_clusters,
+                         link_clusters_src, link_clusters_sink, remove_clusters, unitigs, links):
     """
-    First part of the transformation: creation of all new unitigs from clusters obtained during the phasing stage
+    First part of the transformation: creation of all new unitigs from clusters obtained during the phasing stage.
+    The unitigs (UnitigRecord) and the links between them are appended to unitigs and links,
+    and the clipped reads of the edge (that are needed to link the unitigs) to read_clips
     """
     full_paths_roots = []
     full_paths_leafs = []
-    full_paths = []
+    full_paths = nx.DiGraph()
     full_clusters = []
 
-    graph = gfapy.Gfa.from_file(StRainyArgs().gfa)
+    #only the segment of the edge is read, the graph is not parsed in the workers
+    segments = get_segment_store(StRainyArgs().gfa)
 
     cl = None
     try:
-        cl = pd.read_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, StRainyArgs().AF), keep_default_na = False)
+        cl = ClusterAssignment.read_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, StRainyArgs().AF))
     except(FileNotFoundError, IndexError):
         logger.debug("%s: No clusters" % edge)
         clusters = []
@@ -618,12 +596,15 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
     if cl is not None:
         SNP_pos = build_data.read_snp(StRainyArgs().snp, edge, StRainyArgs().bam, StRainyArgs().AF)
         data = build_data.read_bam(StRainyArgs().bam, edge, SNP_pos, min_mapping_quality,min_base_quality,min_al_len, de_max[StRainyArgs().mode])
-        bam_cache[edge] = data
+        read_clips[edge] = {read: {"Rclip": info["Rclip"], "Lclip": info["Lclip"]} for read, info in data.items()
+                            if info["Rclip"] or info["Lclip"]}
+        #(cluster, left, right, polished, insertmain) of the new unitigs
+        children = []
 
         ln = int(pysam.samtools.coverage("-r", edge, StRainyArgs().bam, "--no-header").split()[4])
-        if len(cl.loc[cl["Cluster"] == 0,"Cluster"].values) > 10:
-            cl.loc[cl["Cluster"] == 0, "Cluster"] = 1000000
-        clusters = sorted(set(cl.loc[cl["Cluster"] != "NA","Cluster"].values))
+        if cl.size(0) > 10:
+            cl.relabel(0, 1000000)
+        clusters = cl.clusters()
 
         try:
             clusters.remove(0)
@@ -640,23 +621,28 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
                 if clStart < start_end_gap and clStop > ln - start_end_gap:
                     full_paths_roots.append(cluster)
                     full_paths_leafs.append(cluster)
-                consensus = flye_consensus.flye_consensus(cluster, edge, cl)
-                # add_child_edge(edge, cluster, graph, cl, consensus["start"], consensus["end"], cons, flye_consensus,change_seq = False)
-                graph_ops.append(['add_child_edge', edge, cluster, cl, consensus["start"], consensus["end"], cons, False, True])
+                #the boundaries come from the read limits, the sequence of the unitig is not changed
+                start, end = flye_consensus.consensus_bounds([cluster], edge, cl)[cluster]
+                children.append((cluster, start, end, False, True))
             link_clusters[edge] = list(clusters)
             link_clusters_sink[edge] = list(clusters)
             link_clusters_src[edge] = list(clusters)
             remove_clusters.add(edge)
 
         if len(clusters) > 1:
+            #the boundaries of the full clusters are found without polishing, their consensuses
+            #are polished with all others of the edge at once (see below)
+            full_bounds = flye_consensus.consensus_bounds([cluster for cluster in clusters
+                                                           if cons[cluster]["Start"] < start_end_gap
+                                                           and cons[cluster]["End"] > ln - start_end_gap
+                                                           and strong_tail(cluster, cl, ln, data) == [True, True]], edge, cl)
             for cluster in clusters:
                 clStart = cons[cluster]["Start"]
                 clStop = cons[cluster]["End"]
                 if clStart < start_end_gap and clStop > ln - start_end_gap:
                     if strong_tail(cluster, cl, ln, data)[0] == True and strong_tail(cluster, cl, ln,data)[1] == True:
-                        consensus = flye_consensus.flye_consensus(cluster, edge, cl)
-                        # add_child_edge(edge, cluster, graph, cl,consensus["start"], consensus["end"], cons, flye_consensus)
-                        graph_ops.append(['add_child_edge', edge, cluster, cl, consensus["start"], consensus["end"], cons, True, True])
+                        start, end = full_bounds[cluster]
+                        children.append((cluster, start, end, True, True))
                         full_clusters.append(cluster)
 
                     elif strong_tail(cluster, cl, ln, data)[0] != True:
@@ -668,7 +654,7 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
                 if clStop > ln - start_end_gap and strong_tail(cluster, cl, ln, data)[1] == True:
                     full_paths_leafs.append(cluster)
 
-            cluster_distances = postprocess.build_adj_matrix_clusters(edge, cons, cl, flye_consensus, False)
+            cluster_distances = postprocess.build_adj_matrix_clusters(edge, cons, cl, flye_consensus, False, R=0)
             cluster_distances = matrix.change_w(cluster_distances,0)
 
             G = build_paths_graph(cons, full_paths_roots, full_paths_leafs, cluster_distances.copy())
@@ -683,19 +669,17 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
                                     full_clusters,
                                     cluster_distances.copy())
 
-            try:
-                full_paths = find_full_paths(G,full_paths_roots, full_paths_leafs)
-            except(ValueError):
-                pass
+            full_paths = find_full_paths(G,full_paths_roots, full_paths_leafs)
 
-            # add_path_edges(edge, graph, cl, data, SNP_pos, ln, full_paths, G,full_paths_roots,
-                        #    full_paths_leafs,full_clusters,cons, flye_consensus)
-            graph_ops.append(['add_path_edges', edge, cl, data, SNP_pos, ln, full_paths, G,full_paths_roots,
-                           full_paths_leafs,full_clusters,cons])
-            # add_path_links(graph, edge, full_paths, G)
-            graph_ops.append(['add_path_links', edge, full_paths, G])
+            #the cuts change the paths, the clusters linked below are taken from the paths before them
+            paths = full_paths.copy()
+            for path_cluster, left, right in path_cluster_cuts(ln, paths, G.copy(), list(full_paths_roots),
+                                                               list(full_paths_leafs), full_clusters, cons):
+                children.append((path_cluster, left, right, True, True))
+            links.extend(path_links(edge, paths))
 
-            othercl = list(set(clusters) - set(full_clusters) - set([j for i in full_paths for j in i]))
+            path_clusters = set(full_paths.nodes())
+            othercl = list(set(clusters) - set(full_clusters) - path_clusters)
             if len(othercl) > 0:
                 G = gfa_ops.from_pandas_adjacency_notinplace(cluster_distances.copy(), create_using = nx.DiGraph)
 
@@ -706,8 +690,7 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
             for cluster in othercl_sorted:
                 neighbors = nx.all_neighbors(G, cluster)
                 A = set(neighbors)
-                B = set([j for i in full_paths for j in i])
-                if len(A.intersection(set(full_clusters))) > 0 or len(A.intersection(B)) > 0: #remove close-to full to avoid duplication
+                if len(A.intersection(set(full_clusters))) > 0 or len(A.intersection(path_clusters)) > 0: #remove close-to full to avoid duplication
                     try:
                         othercl.remove(cluster)
                         close_to_full.append(cluster)
@@ -724,23 +707,28 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
                             pass
 
 
-            new_cov = change_cov(graph, edge, cons, ln, clusters, othercl, remove_clusters)
-            if  new_cov < parental_min_coverage and len(clusters) - len(othercl) != 0 and (len(set(full_clusters))>0 or len(full_paths)>0):
+            new_cov = change_cov(segments, edge, cons, ln, clusters, othercl, remove_clusters)
+            if  new_cov < parental_min_coverage and len(clusters) - len(othercl) != 0 and (len(set(full_clusters))>0 or full_paths.number_of_nodes()>0):
                 remove_clusters.add(edge)
             else:
                 for cluster in othercl:
-                    consensus = flye_consensus.flye_consensus(cluster, edge, cl)
-                    # add_child_edge(edge, cluster, graph, cl, cons[cluster]["Start"], cons[cluster]["End"], cons, flye_consensus,insertmain=False)
-                    graph_ops.append(['add_child_edge', edge, cluster, cl, cons[cluster]["Start"], cons[cluster]["End"], cons, True, False])
+                    children.append((cluster, cons[cluster]["Start"], cons[cluster]["End"], True, False))
                 remove_clusters.add(edge)
 
             link_clusters[edge] = list(full_clusters) + list(
-                set(full_paths_roots).intersection(set([j for i in full_paths for j in i]))) + list(
-                set(full_paths_leafs).intersection(set([j for i in full_paths for j in i])))
+                set(full_paths_roots).intersection(path_clusters)) + list(
+                set(full_paths_leafs).intersection(path_clusters))
             link_clusters_src[edge] = list(full_clusters) + list(
-                set(full_paths_roots).intersection(set([j for i in full_paths for j in i])))
+                set(full_paths_roots).intersection(path_clusters))
             link_clusters_sink[edge] = list(full_clusters) + list(
-                set(full_paths_leafs).intersection(set([j for i in full_paths for j in i])))
+                set(full_paths_leafs).intersection(path_clusters))
+
+        #the consensuses of the edge are polished at once, only the finished sequences are returned
+        polished = [(cluster, edge, cl) for cluster, _, _, polish, _ in children if polish]
+        consensuses = dict(zip([target[0] for target in polished], flye_consensus.flye_consensus_batch(polished)))
+        for cluster, left, right, polish, insertmain in children:
+            unitigs.append(child_unitig(edge, cluster, left, right, cons,
+                                        consensuses[cluster] if polish else None, segments, insertmain))
 
     stats = open("%s/stats_clusters.txt" % StRainyArgs().output_intermediate, "a")
     fcN = 0
@@ -752,7 +740,7 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
         pass
 
     try:
-        fpN = len(set([j for i in full_paths for j in i]))
+        fpN = full_paths.number_of_nodes()
     except KeyError:
         pass
 
@@ -762,45 +750,64 @@ def graph_create_unitigs(edge, flye_consensus, bam_cache, link_clusters,
     stats.close()
 
 
-def graph_link_unitigs(edge, graph, nx_graph,  bam_cache, link_clusters, link_clusters_src,
+_cluster_assignments = {}
+
+def load_cluster_assignment(edge):
+    """
+    Per-process cache of the cluster assignments of the phase stage, None if the edge has no clusters.
+    The assignments are only read here, so they are shared by all linking tasks of the process
+    """
+    path = "%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, StRainyArgs().AF)
+    if path not in _cluster_assignments:
+        try:
+            _cluster_assignments[path] = ClusterAssignment.read_csv(path)
+        except(FileNotFoundError):
+            _cluster_assignments[path] = None
+    return _cluster_assignments[path]
+
+
+def hop_neighbourhood(nx_graph, edge, hops):
+    """
+    Segments that are connected to the edge by a path of at most hops segments (the edge included)
+    """
+    if edge not in nx_graph:
+        return set()
+    return set(nx.single_source_shortest_path_length(nx_graph, edge, cutoff=hops - 1))
+
+
+def graph_link_unitigs(edge, segment_names, nx_graph, read_clips, link_clusters, link_clusters_src,
                        link_clusters_sink, remove_clusters):
     """
-    Second part of the transformation: linkage of all new unitigs created during the first tranforming stage
+    Second part of the transformation: linkage of all new unitigs created during the first tranforming stage.
+    Returns the links (from, from orientation, to, to orientation, weight) of the unitigs of the edge,
+    segment_names are the names of all segments of the graph
     """
     logger.debug(f"Linking {edge}")
+    links = []
     link_added = False
 
     clusters = link_clusters[edge]
-
-    try:
-        cl = pd.read_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, edge, I, StRainyArgs().AF), keep_default_na = False)
-    except(FileNotFoundError):
-        pass
-    link_unitigs = []
-
-    for phase_clust in set(clusters):
-        try:
-            if graph.try_get_segment("%s_%s" % (edge, phase_clust)):
-                link_unitigs.append(phase_clust)
-        except:
-            continue
+    cl = load_cluster_assignment(edge)
+    link_unitigs = [phase_clust for phase_clust in set(clusters) if "%s_%s" % (edge, phase_clust) in segment_names]
+    #the segments that the clipped reads may connect to are the same for all clusters of the edge
+    neighbourhood = hop_neighbourhood(nx_graph, edge, max_hops) if link_unitigs else set()
 
     #for each cluster in the initial unitig
     for cur_clust in link_unitigs:
         #print(f"PROCESSING incoming cluster {cur_clust}")
-        cluster_reads = list(cl.loc[cl["Cluster"] == cur_clust, "ReadName"])
+        cluster_reads = cl.reads(cur_clust)
         neighbours = {}
         orient = {}
 
         #get split reads, identify which unitigs they connect and in which orientation
-        read_data = bam_cache[edge]
+        #only the reads with clips are kept
+        read_data = read_clips[edge]
         for read in cluster_reads:
+            if read not in read_data:
+                continue
             for next_seg, link_orientation in read_data[read]["Rclip"]:
-                try:
-                    if len(nx.shortest_path(nx_graph, next_seg, edge)) <= max_hops:
-                        neighbours[read] = next_seg
-                except (nx.NetworkXNoPath, nx.NodeNotFound):
-                    pass
+                if next_seg in neighbourhood:
+                    neighbours[read] = next_seg
 
                 if link_orientation == "+":
                     orient[next_seg] = ("+", "+")
@@ -808,11 +815,8 @@ def graph_link_unitigs(edge, graph, nx_graph,  bam_cache, link_clusters, link_cl
                     orient[next_seg] = ("+", "-")
 
             for next_seg, link_orientation in read_data[read]["Lclip"]:
-                try:
-                    if len(nx.shortest_path(nx_graph, next_seg, edge)) <= max_hops:
-                        neighbours[read] = next_seg
-                except (nx.NetworkXNoPath, nx.NodeNotFound):
-                    pass
+                if next_seg in neighbourhood:
+                    neighbours[read] = next_seg
 
                 if link_orientation == "+":
                     orient[next_seg] = ("-", "-")
@@ -822,38 +826,30 @@ def graph_link_unitigs(edge, graph, nx_graph,  bam_cache, link_clusters, link_cl
         #print("Neighbors", neighbours)
 
         #for each "neighbor" (a potential unitig-unitig connection derived from reads)
-        for next_seg in set({k for k, v in Counter(neighbours.values()).items() if v >= min_reads_neighbour}):
+        #in a fixed order, so that the links do not depend on the process that made them
+        for next_seg in sorted(k for k, v in Counter(neighbours.values()).items() if v >= min_reads_neighbour):
             #print(f"\tPROCESSING outgoing segment {next_seg}")
             fr_or, to_or = orient[next_seg]
-            try:
-                cl_n = pd.read_csv("%s/clusters/clusters_%s_%s_%s.csv" % (StRainyArgs().output_intermediate, next_seg,
-                                                                          I, StRainyArgs().AF), keep_default_na = False)
-            except(FileNotFoundError):
-                gfa_ops.add_link(graph, f"{edge}_{cur_clust}", fr_or, next_seg, to_or, 555)
+            cl_n = load_cluster_assignment(next_seg)
+            if cl_n is None:
+                links.append((f"{edge}_{cur_clust}", fr_or, next_seg, to_or, 555))
                 continue
 
             #for each neighbor, identify which clusters should be connected
-            connecting_reads = []
-            for read, read_adj in neighbours.items():
-                if read_adj == next_seg:
-                    connecting_reads.append(read)
-            connected_clusters = cl_n.loc[cl_n["ReadName"].isin(connecting_reads), "Cluster"]
-            connected_clusters_thld = list(set([x for x in list(Counter(list(connected_clusters)))
-                                            if Counter(list(connected_clusters))[x]  >= min_reads_cluster]))
-            #print("Connected clusters", connected_clusters)
+            connecting_reads = [read for read, read_adj in neighbours.items() if read_adj == next_seg]
+            connected_counts = Counter(list(cl_n.clusters_of(connecting_reads)))
+            connected_clusters_thld = list(set([x for x, count in connected_counts.items() if count >= min_reads_cluster]))
+            #print("Connected clusters", connected_counts)
             #print("Clusters thld", connected_clusters_thld)
 
             #make cluster-cluster connections
             link_added = False
             for next_clust in connected_clusters_thld:
-                w = Counter(list(connected_clusters))[next_clust]
-                try:
-                    if graph.try_get_segment(f"{next_seg}_{next_clust}"):
-                        gfa_ops.add_link(graph, f"{edge}_{cur_clust}", fr_or, f"{next_seg}_{next_clust}", to_or, w)
-                        #print(f"Direct link: {edge}_{cur_clust} to {next_seg}_{next_clust}, {w}")
-                        link_added = True
-                except(gfapy.NotFoundError):
-                    continue
+                w = connected_counts[next_clust]
+                if f"{next_seg}_{next_clust}" in segment_names:
+                    links.append((f"{edge}_{cur_clust}", fr_or, f"{next_seg}_{next_clust}", to_or, w))
+                    #print(f"Direct link: {edge}_{cur_clust} to {next_seg}_{next_clust}, {w}")
+                    link_added = True
 
             #in case nothing was connected, either connect it to all starts/ends for the other uinig
             #or, if the partent segment is not deleted, connect to parent segment
@@ -874,17 +870,62 @@ def graph_link_unitigs(edge, graph, nx_graph,  bam_cache, link_clusters, link_cl
                         pass
 
                     for next_clust in rewire_clusters:
-                        try:
-                            if graph.try_get_segment(f"{next_seg}_{next_clust}"):
-                                #link_added = True
-                                gfa_ops.add_link(graph, f"{edge}_{cur_clust}", fr_or, f"{next_seg}_{next_clust}", to_or, 666)
-                        except(gfapy.NotFoundError):
-                            pass
+                        if f"{next_seg}_{next_clust}" in segment_names:
+                            #link_added = True
+                            links.append((f"{edge}_{cur_clust}", fr_or, f"{next_seg}_{next_clust}", to_or, 666))
 
                 else:
-                    gfa_ops.add_link(graph, f"{edge}_{cur_clust}", fr_or, next_seg, to_or, 666)
+                    links.append((f"{edge}_{cur_clust}", fr_or, next_seg, to_or, 666))
                     #link_added = True
             ###### end block of non-connection
+    return links
+
+
+#the linking state is sent once to every worker of the linking pool
+_link_state = None
+
+def _init_link_worker(state, args):
+    global _link_state
+    init_global_args_storage(args)
+    set_thread_logging(StRainyArgs().log_transform, "link", multiprocessing.current_process().pid)
+    _link_state = state
+
+
+def _link_worker(edge, edge_clips):
+    segment_names, nx_graph, link_clusters, link_clusters_src, link_clusters_sink, remove_clusters = _link_state
+    try:
+        return graph_link_unitigs(edge, segment_names, nx_graph, {edge: edge_clips}, link_clusters,
+                                  link_clusters_src, link_clusters_sink, remove_clusters)
+    except Exception as e:
+        logger.error("Worker thread exception! " + str(e) + "\n" + traceback.format_exc())
+        raise e
+
+
+def parallelize_link(num_threads, graph, edges, read_clips, link_clusters, link_clusters_src,
+                     link_clusters_sink, remove_clusters, args):
+    """
+    Links the new unitigs of the edges in parallel. The links of every edge are computed independently,
+    and are added to the graph in the order of the edges, so the result does not depend on the number of threads
+    """
+    nx_graph = gfa_ops.gfa_to_nx(graph)
+    segment_names = set(graph.segment_names)
+    state = (segment_names, nx_graph, link_clusters, link_clusters_src, link_clusters_sink, remove_clusters)
+    #the edges without new unitigs have nothing to link
+    tasks = [(edge, read_clips.get(edge, {})) for edge in edges if len(link_clusters.get(edge, [])) > 0]
+    if num_threads == 1 or len(tasks) < 2:
+        result_values = [graph_link_unitigs(edge, segment_names, nx_graph, read_clips, link_clusters, link_clusters_src,
+                                            link_clusters_sink, remove_clusters) for edge, _ in tasks]
+    else:
+        with multiprocessing.Pool(min(num_threads, len(tasks)), initializer=_init_link_worker,
+                                  initargs=(state, args)) as pool:
+            result_values = pool.starmap(_link_worker, tasks, chunksize=1)
+
+    n_links = 0
+    for links in result_values:
+        for fr, fr_or, to, to_or, w in links:
+            gfa_ops.add_link(graph, fr, fr_or, to, to_or, w)
+        n_links += len(links)
+    logger.info(f"{n_links} links between the unitigs")
 
 
 def connect_parental_edges(graph, link_clusters_src, link_clusters_sink, remove_clusters):
@@ -973,6 +1014,8 @@ def transform_main(args):
     """
     HARD_LIMIT = 16
     num_threads = min(StRainyArgs().threads, HARD_LIMIT)
+    #the segments are indexed before the workers are forked, so that they inherit the index
+    get_segment_store(StRainyArgs().gfa)
     pool = None
     if StRainyArgs().threads != 1:
         pool = multiprocessing.Pool(num_threads)
@@ -988,18 +1031,26 @@ def transform_main(args):
         ref_coverage[edge] = round(float(edge_cov))
 
     logger.info("Loading phased unitigs dictionary")
-    try:
-        with open(os.path.join(StRainyArgs().output_intermediate, consensus_cache_path), "rb") as f:
-            logger.debug(f"searching consensus cache in {os.getcwd()}")
-            consensus_dict = pickle.load(f)
-    except FileNotFoundError:
-        consensus_dict = {}
-
-    flye_consensus = FlyeConsensus(StRainyArgs().bam, StRainyArgs().fa, args.threads, consensus_dict, default_manager)
+    #the consensus log of phase is read lazily, the dictionary of the earlier versions is loaded entirely
+    saved_consensus = ConsensusLog(os.path.join(StRainyArgs().output_intermediate, consensus_log_path))
+    consensus_dict = {}
+    if saved_consensus.exists():
+        logger.info(f"Found {len(saved_consensus)} consensuses in the consensus log")
+    else:
+        saved_consensus = None
+        try:
+            with open(os.path.join(StRainyArgs().output_intermediate, consensus_cache_path), "rb") as f:
+                logger.debug(f"searching consensus cache in {os.getcwd()}")
+                consensus_dict = pickle.load(f)
+        except FileNotFoundError:
+            consensus_dict = {}
+
+    flye_consensus = FlyeConsensus(StRainyArgs().bam, StRainyArgs().fa, args.threads, consensus_dict, default_manager,
+                                   saved_consensus=saved_consensus)
     consensus_dict = {}
 
     logger.info("### Create unitigs")
-    bam_cache, link_clusters, link_clusters_src, link_clusters_sink, remove_clusters, initial_graph = \
+    read_clips, link_clusters, link_clusters_src, link_clusters_sink, remove_clusters, initial_graph = \
             parallelize_gcu(pool, StRainyArgs().edges, flye_consensus, initial_graph, args)
 
     # Save phased and reference unitigs' info as a csv
@@ -1012,10 +1063,8 @@ def transform_main(args):
     #logger.info('Done!')
 
     logger.info("### Link unitigs")
-    nx_graph = gfa_ops.gfa_to_nx(initial_graph)
-    for edge in StRainyArgs().edges:
-        graph_link_unitigs(edge, initial_graph, nx_graph, bam_cache, link_clusters, link_clusters_src,
-                           link_clusters_sink, remove_clusters)
+    parallelize_link(num_threads, initial_graph, StRainyArgs().edges, read_clips, link_clusters, link_clusters_src,
+                     link_clusters_sink, remove_clusters, args)
     connect_parental_edges(initial_graph, link_clusters_src, link_clusters_sink, remove_clusters)
 
     logger.info("### Remove initial segments")
@@ -1067,4 +1116,6 @@ def transform_main(args):
                         strain_utgs_aln, open(vcf_strain_variants, "w"))
 
     flye_consensus.print_cache_statistics()
+    flye_consensus.evict_persistent_cache()
+    flye_consensus.cleanup_scratch()
     logger.info("### Done!")
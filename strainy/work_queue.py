@@ -0,0 +1,126 @@
+import time
+import queue
+import logging
+import traceback
+
+
+logger = logging.getLogger()
+
+
+class WorkQueue:
+    """
+    Shares the independent sub-work of large unitigs (distance matrix tiles,
+    cluster consensus polishing) between the phase workers.
+    Workers that have no unitigs left to process become helpers and take jobs
+    from a shared queue until all unitigs are finished. The worker that submits
+    jobs executes them as well, so the results are ready even if no helper is free.
+    """
+    def __init__(self, multiproc_manager, num_unitigs):
+        self._jobs = multiproc_manager.Queue()
+        self._results = multiproc_manager.dict()
+        self._finished = multiproc_manager.dict()
+        self._lock = multiproc_manager.Lock()
+        self._unfinished_unitigs = multiproc_manager.Value("i", num_unitigs)
+        self._idle_helpers = multiproc_manager.Value("i", 0)
+        self._batch_counter = multiproc_manager.Value("i", 0)
+
+    def idle_helpers(self):
+        return self._idle_helpers.value
+
+    def unitig_finished(self):
+        with self._lock:
+            self._unfinished_unitigs.value -= 1
+
+    def map(self, func, args_list):
+        """
+        Returns [func(*args) for args in args_list], running the calls on the idle workers
+        (and on the current one) if any of them are available.
+        The arguments and the results pass through the manager, so large data should be
+        shared by reference (a file or a shared memory block named in the arguments)
+        """
+        if len(args_list) < 2 or self.idle_helpers() == 0:
+            return [func(*args) for args in args_list]
+
+        with self._lock:
+            batch = self._batch_counter.value
+            self._batch_counter.value += 1
+            self._finished[batch] = 0
+        for i, args in enumerate(args_list):
+            self._jobs.put(((batch, i), func, args))
+        logger.debug(f"Shared {len(args_list)} jobs with {self.idle_helpers()} idle workers")
+
+        while self._finished[batch] < len(args_list):
+            if not self._run_next_job(block=False):
+                time.sleep(0.01)
+
+        results = []
+        for i in range(len(args_list)):
+            success, result = self._results.pop((batch, i))
+            if not success:
+                raise Exception("Error in shared job:\n" + result)
+            results.append(result)
+        del self._finished[batch]
+        return results
+
+    def help(self):
+        """
+        Runs the shared jobs until all unitigs are finished
+        """
+        with self._lock:
+            self._idle_helpers.value += 1
+        try:
+            while self._unfinished_unitigs.value > 0:
+                self._run_next_job(block=True)
+        finally:
+            with self._lock:
+                self._idle_helpers.value -= 1
+
+    def _run_next_job(self, block):
+        try:
+            key, func, args = self._jobs.get(block=block, timeout=0.1 if block else None)
+        except queue.Empty:
+            return False
+
+        try:
+            self._results[key] = (True, func(*args))
+        except Exception:
+            self._results[key] = (False, traceback.format_exc())
+        #the submitter polls the number of finished jobs of the batch
+        batch = key[0]
+        with self._lock:
+            self._finished[batch] += 1
+        return True
+
+
+_work_queue = None
+#objects the shared jobs refer to by name instead of carrying them, in the current process
+_shared_objects = {}
+
+def set_work_queue(work_queue):
+    global _work_queue
+    _work_queue = work_queue
+
+
+def shared_map(func, args_list):
+    """
+    Maps func over args_list through the work queue of the current process,
+    or serially if there is none (single-threaded run)
+    """
+    if _work_queue is None:
+        return [func(*args) for args in args_list]
+    return _work_queue.map(func, args_list)
+
+
+def idle_helpers():
+    return 0 if _work_queue is None else _work_queue.idle_helpers()
+
+
+def share_object(name, obj):
+    """
+    Makes obj available to the shared jobs of the current process by name (see shared_object)
+    """
+    _shared_objects[name] = obj
+
+
+def shared_object(name):
+    return _shared_objects[name]
@@ -0,0 +1,152 @@
+import random
+
+import pytest
+
+pytest.importorskip("flye")
+
+from strainy.flye_consensus import FlyeConsensus
+
+
+def previous_coverage(position, bed_file_content):
+    for row in bed_file_content:
+        if row[0] <= position <= row[1]:
+            return row[2]
+    return 0
+
+
+def previous_mismatch_position(cons_to_cons, cons_to_ref, reference, mismatch_index, first_cl_start):
+    #_get_true_mismatch_position before the linear time scoring, on the gapped alignment strings
+    true_pos_cons_to_cons = mismatch_index - cons_to_cons[:mismatch_index].count('-') + first_cl_start + 1
+    true_pos_cons_to_ref = -1
+    bases = 0
+    for i, b in enumerate(cons_to_ref):
+        if b != '-':
+            bases += 1
+        if bases == true_pos_cons_to_cons:
+            true_pos_cons_to_ref = i
+            break
+    if true_pos_cons_to_ref == -1:
+        return true_pos_cons_to_ref
+    return true_pos_cons_to_ref - reference[:true_pos_cons_to_ref].count('-') + 1
+
+
+def previous_score(aligned_first, alignment_string, aligned_second, first_to_ref, reference_to_first,
+                   intersection_start, first_cl_dict, second_cl_dict, commonSNPs, first_cl_start,
+                   coverage_limit, indel_block_length_leniency):
+    #_custom_scoring_function before the linear time scoring, returns (score, position hits, position misses)
+    score = 0
+    hits = 0
+    misses = 0
+    indel_length = 0
+    indel_block_start = -1
+    alignment_list = list(alignment_string)
+    first_shift = intersection_start - first_cl_dict['start']
+    second_shift = intersection_start - second_cl_dict['start']
+
+    for i, base in enumerate(alignment_list):
+        cl1_true_coor = first_shift + i - aligned_first[:i].count('-')
+        cl2_true_coor = second_shift + i - aligned_second[:i].count('-')
+        if ((base == '-' or base == '.')
+                and (previous_coverage(cl1_true_coor, first_cl_dict['bed_content']) < coverage_limit
+                or previous_coverage(cl2_true_coor, second_cl_dict['bed_content']) < coverage_limit)):
+            base = '|'
+
+        if base == '-':
+            if i == 0:
+                indel_length = 1
+                indel_block_start = i
+                continue
+            elif i == (len(alignment_list) - 1):
+                break
+            else:
+                if alignment_list[i - 1] != '-':
+                    indel_block_start = i
+                    indel_length = 1
+                else:
+                    indel_length += 1
+        elif i != 0 and alignment_list[i - 1] == '-':
+            if indel_length >= indel_block_length_leniency and indel_block_start != 0:
+                score += indel_length
+            indel_length = 0
+
+        if base == '.':
+            mismatch_position = previous_mismatch_position(aligned_first, first_to_ref, reference_to_first, i,
+                                                           intersection_start - first_cl_start) + first_cl_start
+            if mismatch_position in commonSNPs:
+                hits += 1
+                score += 1
+            else:
+                misses += 1
+    return score, hits, misses
+
+
+def mutate(rnd, sequence):
+    result = []
+    i = 0
+    while i < len(sequence):
+        event = rnd.random()
+        if event < 0.03:
+            result.append(rnd.choice([b for b in "ACGT" if b != sequence[i]]))
+            i += 1
+        elif event < 0.04:
+            result.append("".join(rnd.choice("ACGT") for _ in range(rnd.randint(1, 9))))
+        elif event < 0.05:
+            i += rnd.randint(1, 9)
+        else:
+            result.append(sequence[i])
+            i += 1
+    return "".join(result)
+
+
+def coverage_rows(rnd, length):
+    #contiguous intervals as in the polisher bed files, some of them below the coverage limit
+    rows = []
+    start = 0
+    while start < length + 20:
+        end = start + rnd.randint(5, 60)
+        rows.append([start, end, rnd.choice([0, 1, 2, 5, 8, 12, 20])])
+        start = end
+    return rows
+
+
+def scorer():
+    flye_consensus = FlyeConsensus.__new__(FlyeConsensus)
+    flye_consensus._token = "test_alignment_scoring"
+    flye_consensus._coverage_limit = 3
+    flye_consensus._indel_block_length_leniency = 5
+    flye_consensus._divergence = 0.1
+    return flye_consensus
+
+
+def test_scores_match_previous_implementation():
+    rnd = random.Random(7)
+    flye_consensus = scorer()
+    for _ in range(400):
+        reference = "".join(rnd.choice("ACGT") for _ in range(rnd.randint(200, 700)))
+        first_start, second_start = rnd.randint(0, 60), rnd.randint(0, 60)
+        first_end, second_end = len(reference) - rnd.randint(0, 60), len(reference) - rnd.randint(0, 60)
+        first = {"start": first_start, "end": first_end, "consensus": mutate(rnd, reference[first_start:first_end])}
+        second = {"start": second_start, "end": second_end, "consensus": mutate(rnd, first["consensus"])}
+        first["bed_content"] = coverage_rows(rnd, len(first["consensus"]))
+        second["bed_content"] = coverage_rows(rnd, len(second["consensus"]))
+
+        intersection_start = max(first_start, second_start)
+        intersection_end = min(first_end, second_end)
+        first_clipped = first["consensus"][intersection_start - first_start:intersection_end - first_start]
+        second_clipped = second["consensus"][intersection_start - second_start:intersection_end - second_start]
+        if len(first_clipped) == 0 or len(second_clipped) == 0:
+            continue
+        aligned_first, aligned_second, alignment = flye_consensus._edlib_align(first_clipped, second_clipped)
+        first_reference = reference[first_start:first_end]
+        first_to_ref, reference_to_first, _ = flye_consensus._edlib_align(first["consensus"], first_reference)
+        first_to_ref_cigar = flye_consensus._edlib_path(first["consensus"], first_reference)["cigar"]
+        commonSNPs = set(rnd.sample(range(len(reference)), len(reference) // 4))
+
+        expected = previous_score(aligned_first, alignment, aligned_second, first_to_ref, reference_to_first,
+                                  intersection_start, first, second, commonSNPs, first_start,
+                                  flye_consensus._coverage_limit, flye_consensus._indel_block_length_leniency)
+        statistics = flye_consensus._local()[1]
+        statistics.clear()
+        score = flye_consensus._custom_scoring_function(aligned_first, alignment, aligned_second, first_to_ref_cigar,
+                                                        intersection_start, first, second, commonSNPs, first_start)
+        assert (score, statistics["position_hit"], statistics["position_miss"]) == expected
@@ -0,0 +1,52 @@
+import random
+import networkx as nx
+
+from strainy.clustering.cluster_postprocess import find_shortcut_edges, find_branching_edges
+
+
+def reduce_with_simple_paths(G, cut_off):
+    #join_clusters reduction before the bitset version
+    G = G.copy()
+    path_remove = []
+    for node in G.nodes():
+        for neighbor in list(nx.all_neighbors(G, node)):
+            for n_path in nx.algorithms.all_simple_paths(G, node, neighbor, cutoff=cut_off):
+                if len(n_path) > 2:
+                    path_remove.append((n_path[0], n_path[-1]))
+    G.remove_edges_from(path_remove)
+
+    lis = list(nx.topological_sort(nx.line_graph(G)))
+    first = [i[0] for i in lis]
+    last = [i[1] for i in lis]
+    to_remove = [i for i in lis if first.count(i[0]) > 1 or last.count(i[1]) > 1]
+    G.remove_edges_from(to_remove)
+    return set(path_remove), set(to_remove), set(G.edges())
+
+
+def reduce_with_bitsets(G, cut_off):
+    G = G.copy()
+    path_remove = find_shortcut_edges(G, cut_off)
+    G.remove_edges_from(path_remove)
+    to_remove = find_branching_edges(G)
+    G.remove_edges_from(to_remove)
+    return set(path_remove), set(to_remove), set(G.edges())
+
+
+def position_ordered_dag(n_clusters, edge_prob, seed):
+    #clusters are ordered by position, edges only go forward as in build_adj_matrix_clusters
+    rnd = random.Random(seed)
+    G = nx.DiGraph()
+    clusters = rnd.sample(range(1, 100 * n_clusters), n_clusters)
+    G.add_nodes_from(clusters)
+    for i in range(n_clusters):
+        for k in range(i + 1, min(n_clusters, i + 8)):
+            if rnd.random() < edge_prob:
+                G.add_edge(clusters[i], clusters[k])
+    return G
+
+
+def test_reduction_matches_simple_paths():
+    for seed in range(200):
+        G = position_ordered_dag(random.Random(seed).randint(1, 30), 0.4, seed)
+        for cut_off in (3, 5):
+            assert reduce_with_bitsets(G, cut_off) == reduce_with_simple_paths(G, cut_off)
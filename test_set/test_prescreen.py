@@ -0,0 +1,86 @@
+import random
+import edlib
+
+import strainy.clustering.build_adj_matrix as matrix
+import strainy.clustering.cluster_postprocess as postprocess
+from strainy.clustering.cluster_assignment import ClusterAssignment
+from strainy.clustering.cluster_postprocess import build_adj_matrix_clusters
+
+
+class AlignedConsensuses:
+    #stands in for FlyeConsensus: the cluster consensuses are given, distances are edit distances
+    def __init__(self, consensuses):
+        self.consensuses = consensuses
+        self.statistics = {}
+
+    def has_consensus(self, cluster, edge):
+        return True
+
+    def add_statistic(self, name, value):
+        self.statistics[name] = self.statistics.get(name, 0) + value
+
+    def flye_consensus_batch(self, targets):
+        pass
+
+    def cluster_distance_via_alignment(self, first_cl, second_cl, cl, edge, commonSNP=[]):
+        return edlib.align(self.consensuses[first_cl], self.consensuses[second_cl])["editDistance"]
+
+
+def same_alleles_with_indel_block(block=10):
+    rnd = random.Random(1)
+    length = 5000
+    sequence = "".join(rnd.choice("ACGT") for _ in range(length))
+    snps = list(range(200, length - 200, 80))
+    cons = {}
+    for cluster in (1, 2):
+        cons[cluster] = {"clSNP": snps, "clSNP2": snps, "Strange": 0, "Strange2": 0,
+                         "Start": 0, "End": length, "Cov": 30}
+        for pos in snps:
+            cons[cluster][pos] = sequence[pos]
+    #the second consensus lacks a block of bases between two SNPs
+    consensuses = {1: sequence, 2: sequence[:2500] + sequence[2500 + block:]}
+    return cons, consensuses, length
+
+
+def discordant_alleles(every=2):
+    cons, consensuses, length = same_alleles_with_indel_block(block=0)
+    sequence = list(consensuses[2])
+    #the second cluster has another allele at every other SNP
+    for i, pos in enumerate(cons[2]["clSNP"]):
+        if i % every == 0:
+            sequence[pos] = {"A": "C", "C": "G", "G": "T", "T": "A"}[sequence[pos]]
+            cons[2][pos] = sequence[pos]
+    consensuses[2] = "".join(sequence)
+    return cons, consensuses, length
+
+
+def test_prescreen_keeps_concordant_pairs():
+    cons, _, _ = same_alleles_with_indel_block()
+    assert matrix.prescreen_pairs([(1, 2)], cons, 0) == {}
+    assert matrix.prescreen_pairs([(1, 2)], cons, 0.1) == {}
+
+
+def test_indel_block_is_not_an_edge():
+    cons, consensuses, length = same_alleles_with_indel_block()
+    cl = ClusterAssignment([f"r{i}" for i in range(20)], [0] * 20, [1] * 10 + [2] * 10)
+    m = build_adj_matrix_clusters("edge_1", cons, cl, AlignedConsensuses(consensuses), True, R=0)
+    assert m.loc[1, 2] == 10 / length
+
+
+def test_distinct_pair_matches_alignment(monkeypatch):
+    cons, consensuses, length = discordant_alleles()
+    cl = ClusterAssignment([f"r{i}" for i in range(20)], [0] * 20, [1] * 10 + [2] * 10)
+    aligned = AlignedConsensuses(consensuses)
+    for R in (0.001, 0.003):
+        decided = matrix.prescreen_pairs([(1, 2)], cons, R)
+        alignment = aligned.cluster_distance_via_alignment(1, 2, cl, "edge_1") / length
+        assert decided == {(1, 2): alignment}
+        #the pair is joined (distance within R) neither by the prescreen nor by the alignment
+        assert decided[(1, 2)] > R and alignment > R
+
+        monkeypatch.setattr(postprocess, "profile_prescreen", False)
+        aligned_m = build_adj_matrix_clusters("edge_1", cons, cl, aligned, True, R=R)
+        monkeypatch.setattr(postprocess, "profile_prescreen", True)
+        prescreened_m = build_adj_matrix_clusters("edge_1", cons, cl, aligned, True, R=R)
+        assert aligned.statistics.get("prescreen_pairs", 0) > 0
+        assert (matrix.change_w(aligned_m, R) > 0).equals(matrix.change_w(prescreened_m, R) > 0)